@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+"""Measure the startup time of the dish_grpc_* scripts.
+
+When the scripts are run in one-shot mode, such as from cron, the time spent
+starting the Python interpreter and importing modules can easily exceed the
+time spent actually talking to the dish. This script measures that part of
+the cost by running a fresh interpreter that imports a script's modules (but
+does not run its main function) several times and reporting the median and
+minimum wall time.
+
+Alternatively, a full command line can be given after "--", in which case
+that command will be timed instead, for example:
+
+    bench_startup.py -n 20 -- python3 dish_grpc_text.py status
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SCRIPTS = [
+    "dish_grpc_text", "dish_grpc_mqtt", "dish_grpc_influx", "dish_grpc_sqlite",
+    "dish_grpc_snapshot", "dish_grpc_stream", "dish_grpc_fanout"
+]
+RUNS_DEFAULT = 10
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Measure the startup time of the dish_grpc_* scripts")
+    parser.add_argument("-n",
+                        "--runs",
+                        type=int,
+                        default=RUNS_DEFAULT,
+                        help="Number of times to run each command, default: " + str(RUNS_DEFAULT))
+    parser.add_argument("command",
+                        nargs="*",
+                        help="Command to time instead of importing each of the scripts")
+
+    return parser.parse_args()
+
+
+def time_command(command, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(command,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        times.append(time.perf_counter() - start)
+        if result.returncode:
+            return None, result.stderr.decode(errors="replace").strip().splitlines()[-1:]
+    return times, None
+
+
+def main():
+    opts = parse_args()
+
+    if opts.command:
+        commands = [(" ".join(opts.command), opts.command)]
+    else:
+        commands = [(script, [sys.executable, "-c", "import " + script]) for script in SCRIPTS]
+
+    rc = 0
+    for name, command in commands:
+        times, error = time_command(command, opts.runs)
+        if times is None:
+            print("{0:20} failed: {1}".format(name, " ".join(error)))
+            rc = 1
+        else:
+            print("{0:20} median {1:7.1f} ms, min {2:7.1f} ms".format(
+                name,
+                statistics.median(times) * 1000,
+                min(times) * 1000))
+
+    sys.exit(rc)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,10 @@ Note:
 import argparse
 from datetime import datetime
 from datetime import timezone
+import json
 import logging
+import math
+import os
 import re
 import time
 
@@ -22,12 +25,29 @@ import starlink_grpc
 BRACKETS_RE = re.compile(r"([^[]*)(\[((\d+),|)(\d*)\]|)$")
 SAMPLES_DEFAULT = 3600
 LOOP_TIME_DEFAULT = 0
+# The dish history buffer currently holds 12 hours of 1 second samples.
+HISTORY_BUFFER_SAMPLES = 43200
+# Fraction of the history buffer left as safety margin when polling less
+# often in adaptive bulk mode.
+BULK_SAFETY_MARGIN = 0.25
+BULK_BACKOFF_MAX = 300.0
+HEARTBEAT_DEFAULT = 60
+RPC_TIMEOUT_DEFAULT = 10.0
+RPC_RETRIES_DEFAULT = 0
+# Keepalive pings are only sent while a request is in progress, so are only
+# used when --rpc-timeout allows requests to run longer than this; the time a
+# request can take is otherwise bounded by its deadline. gRPC servers by
+# default send GOAWAY with too_many_pings to clients that ping more often
+# than every 5 minutes, so don't go below that.
+RPC_KEEPALIVE = 300.0
+BREAKER_THRESHOLD = 3
+BREAKER_RESET = 10.0
 STATUS_MODES = ["status", "obstruction_detail", "alert_detail"]
-PING_MODES = ["ping_drop", "ping_run_length"]
+PING_MODES = ["ping_drop", "ping_run_length", "ping_latency"]
 UNGROUPED_MODES = []
 
 
-def create_arg_parser(output_description, bulk_history=True):
+def create_arg_parser(output_description, bulk_history=True, outages=False):
     """Create an argparse parser and add the common command line options."""
     parser = argparse.ArgumentParser(
         description="Collect status and/or history data from a Starlink user terminal and " +
@@ -40,6 +60,8 @@ def create_arg_parser(output_description, bulk_history=True):
     all_modes = STATUS_MODES + PING_MODES + UNGROUPED_MODES
     if bulk_history:
         all_modes.append("bulk_history")
+    if outages:
+        all_modes.append("outages")
     parser.add_argument("mode",
                         nargs="+",
                         choices=all_modes,
@@ -54,7 +76,38 @@ def create_arg_parser(output_description, bulk_history=True):
                        default=float(LOOP_TIME_DEFAULT),
                        help="Loop interval in seconds or 0 for no loop, default: " +
                        str(LOOP_TIME_DEFAULT))
+    group.add_argument("-i",
+                       "--mode-interval",
+                       action="append",
+                       type=parse_mode_interval,
+                       default=[],
+                       help="Loop interval in seconds to use for a specific mode instead of the "
+                       "one set by --loop-interval, which must also be set; may be used multiple "
+                       "times",
+                       metavar="MODE=SECONDS")
     group.add_argument("-v", "--verbose", action="store_true", help="Be verbose")
+    group.add_argument("--changes-only",
+                       action="store_true",
+                       help="Only output status and history stat values that have changed since "
+                       "they were last output, except for periodic heartbeat")
+    group.add_argument("--heartbeat",
+                       type=float,
+                       default=float(HEARTBEAT_DEFAULT),
+                       help="With --changes-only, output all values anyway after this many "
+                       "minutes, default: " + str(HEARTBEAT_DEFAULT),
+                       metavar="MINUTES")
+    group.add_argument("--rpc-timeout",
+                       type=float,
+                       default=RPC_TIMEOUT_DEFAULT,
+                       help="Time limit in seconds for each request to the dish, or 0 for no "
+                       "limit, default: " + str(RPC_TIMEOUT_DEFAULT),
+                       metavar="SECONDS")
+    group.add_argument("--rpc-retries",
+                       type=int,
+                       default=RPC_RETRIES_DEFAULT,
+                       help="Number of times to retry a failed request to the dish, with "
+                       "increasing delay between attempts, default: " + str(RPC_RETRIES_DEFAULT),
+                       metavar="N")
 
     group = parser.add_argument_group(title="History mode options")
     group.add_argument("-a",
@@ -71,11 +124,35 @@ def create_arg_parser(output_description, bulk_history=True):
         sample_help = ("Number of data samples to parse, default: loop interval, if set, else " +
                        str(SAMPLES_DEFAULT))
     group.add_argument("-s", "--samples", type=int, help=sample_help)
+    if bulk_history:
+        group.add_argument("--adaptive-bulk",
+                           action="store_true",
+                           help="In bulk mode, instead of every loop iteration, poll history data "
+                           "only as often as needed to avoid losing samples when the dish's "
+                           "history buffer wraps, which may be hours apart; other modes still use "
+                           "loop interval")
+        group.add_argument("--state-file",
+                           help="In bulk mode, save the sample counter and time base to this file "
+                           "once the samples have been output, and resume from there on the next "
+                           "run, so that repeated one-shot runs only output new samples",
+                           metavar="FILENAME")
 
     return parser
 
 
-def run_arg_parser(parser, need_id=False, no_stdout_errors=False):
+def parse_mode_interval(arg):
+    """Parse a MODE=SECONDS option argument into a (mode, interval) tuple."""
+    mode, sep, interval = arg.partition("=")
+    try:
+        interval = float(interval)
+    except ValueError:
+        interval = None
+    if not sep or interval is None or interval <= 0.0:
+        raise argparse.ArgumentTypeError("expected MODE=SECONDS, with SECONDS > 0: " + arg)
+    return mode, interval
+
+
+def run_arg_parser(parser, need_id=False, no_stdout_errors=False, args=None):
     """Run parse_args on a parser previously created with create_arg_parser
 
     Args:
@@ -85,23 +162,45 @@ def run_arg_parser(parser, need_id=False, no_stdout_errors=False):
         no_stdout_errors (bool): A flag set in options to protect stdout from
             error messages, in case that's where the data output is going, so
             may be being redirected to a file.
+        args (list): Optionally, the list of arguments to parse instead of
+            those on the command line.
 
     Returns:
         An argparse Namespace object with the parsed options set as attributes.
     """
-    opts = parser.parse_args()
+    opts = parser.parse_args(args)
 
     # for convenience, set flags for whether any mode in a group is selected
     opts.satus_mode = bool(set(STATUS_MODES).intersection(opts.mode))
     opts.ping_mode = bool(set(PING_MODES).intersection(opts.mode))
     opts.bulk_mode = "bulk_history" in opts.mode
+    opts.outage_mode = "outages" in opts.mode
+
+    # Each mode gets its own loop interval, defaulting to the shared one, and
+    # the main loop then runs at the shortest of them.
+    opts.mode_intervals = {mode: opts.loop_interval for mode in opts.mode}
+    for mode, interval in opts.mode_interval:
+        if mode not in opts.mode:
+            parser.error("Mode interval set for mode that is not selected: " + mode)
+        if opts.loop_interval <= 0.0:
+            parser.error("Mode interval can only be used when loop interval is set")
+        opts.mode_intervals[mode] = interval
+    opts.loop_interval = min(opts.mode_intervals.values())
 
     if opts.samples is None:
+        # ping stats should cover the time since they were last computed
+        ping_interval = min(
+            (opts.mode_intervals[mode] for mode in PING_MODES if mode in opts.mode),
+            default=opts.loop_interval)
         opts.samples = -1 if opts.bulk_mode else int(
-            opts.loop_interval) if opts.loop_interval >= 1.0 else SAMPLES_DEFAULT
+            ping_interval) if ping_interval >= 1.0 else SAMPLES_DEFAULT
 
     opts.no_stdout_errors = no_stdout_errors
-    opts.need_id = need_id
+    # the state file is only valid for the dish that wrote it, so need the ID
+    # to check that
+    opts.state_file = getattr(opts, "state_file", None) if opts.bulk_mode else None
+    opts.adaptive_bulk = getattr(opts, "adaptive_bulk", False) and opts.loop_interval > 0.0
+    opts.need_id = need_id or opts.state_file is not None
 
     return opts
 
@@ -116,19 +215,397 @@ def conn_error(opts, msg, *args):
         logging.error(msg, *args)
 
 
-class GlobalState:
-    """A class for keeping state across loop iterations."""
+def load_state_file(filename):
+    """Load a dict previously saved with save_state_file.
+
+    Returns:
+        The dict that was saved, or an empty dict if the file does not exist
+        or could not be read.
+    """
+    try:
+        with open(filename) as state_file:
+            state = json.load(state_file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning("Failed reading state file, ignoring it: %s", str(e))
+        return {}
+    return state if isinstance(state, dict) else {}
+
+
+def save_state_file(filename, state):
+    """Save a dict to a file in JSON format, replacing it atomically.
+
+    Returns:
+        True if the file was written, otherwise False.
+    """
+    tmp_filename = filename + ".tmp"
+    try:
+        with open(tmp_filename, "w") as state_file:
+            json.dump(state, state_file)
+        os.replace(tmp_filename, filename)
+    except OSError as e:
+        logging.error("Failed writing state file: %s", str(e))
+        return False
+    return True
+
+
+def save_bulk_state(opts, gstate, counter=None, timestamp=None):
+    """Save the bulk mode sample counter and time base to the state file.
+
+    This does nothing unless the state_file option is set. Output scripts
+    should only call it once the bulk data from get_data has actually been
+    output, so that data that did not make it out gets fetched again on the
+    next run, instead of being skipped.
+
+    Args:
+        opts (object): The options object returned from run_arg_parser.
+        gstate (GlobalState): The state object passed to get_data.
+        counter (int): Optionally, the counter value of the last sample
+            output, if not the last one returned by get_data.
+        timestamp (int): The time of the last sample output, if counter is
+            set.
+    """
+    if not opts.state_file:
+        return
+    if counter is None:
+        counter = gstate.counter
+        timestamp = gstate.timestamp
+    if counter is None or (counter, timestamp) == gstate.saved_state:
+        return
+    if save_state_file(opts.state_file, {
+            "dish_id": gstate.dish_id,
+            "end_counter": counter,
+            "timestamp": timestamp,
+    }):
+        gstate.saved_state = (counter, timestamp)
+
+
+class BulkScheduler:
+    """Decide when to next poll history data in adaptive bulk mode.
+
+    The dish records history samples in a ring buffer, so it only needs to be
+    polled often enough that the buffer does not wrap around between polls.
+    If samples are lost anyway, the buffer must be smaller than expected, so
+    the poll interval is tightened to fit the number of samples that could be
+    retrieved. While the dish is not reachable, polling backs off
+    exponentially, but is capped so as not to miss its return for too long.
+
+    Args:
+        min_interval (float): Shortest interval, in seconds, at which to poll.
+    """
+    def __init__(self, min_interval):
+        self.min_interval = max(min_interval, 1.0)
+        self.buffer_samples = HISTORY_BUFFER_SAMPLES
+        self.failures = 0
+        self.next_poll = time.monotonic()
+
+    @property
+    def interval(self):
+        return max(self.buffer_samples * (1.0 - BULK_SAFETY_MARGIN), self.min_interval)
+
+    def due(self):
+        return time.monotonic() >= self.next_poll
+
+    def poll_succeeded(self, parsed_samples, lost_samples):
+        self.failures = 0
+        if lost_samples > 0:
+            self.buffer_samples = min(self.buffer_samples, parsed_samples)
+        self.next_poll = time.monotonic() + self.interval
+
+    def poll_failed(self):
+        self.failures += 1
+        backoff = self.min_interval * 2.0**min(self.failures - 1, 16)
+        self.next_poll = time.monotonic() + min(backoff, BULK_BACKOFF_MAX, self.interval)
+
+
+def filter_changes(opts, gstate, add_item, add_sequence):
+    """Wrap get_data call backs to pass along only values that have changed.
+
+    The values last passed along are tracked in gstate, and are forgotten
+    every heartbeat interval, so that all values get passed along
+    periodically.
+
+    Returns:
+        A tuple with the wrapped add_item and add_sequence call backs.
+    """
+    now = time.monotonic()
+    if gstate.next_heartbeat is None or now >= gstate.next_heartbeat:
+        gstate.last_values.clear()
+        gstate.next_heartbeat = now + opts.heartbeat * 60.0
+
+    def changed(name, val, category):
+        key = (category, name)
+        if key in gstate.last_values and gstate.last_values[key] == val:
+            return False
+        gstate.last_values[key] = val
+        return True
+
+    def filtered_add_item(name, val, category):
+        if changed(name, val, category):
+            add_item(name, val, category)
+
+    def filtered_add_sequence(name, val, category, start):
+        if changed(name, tuple(val), category):
+            add_sequence(name, val, category, start)
+
+    return filtered_add_item, filtered_add_sequence
+
+
+def _percentile(sorted_values, fraction):
+    # nearest-rank method
+    return sorted_values[max(math.ceil(len(sorted_values) * fraction) - 1, 0)]
+
+
+class BulkRollup:
+    """Aggregate bulk history samples into fixed length time windows.
+
+    Each window's aggregate values are computed once a sample from a later
+    window is added. If the first sample added is not at the start of a
+    window, that window is skipped, since its aggregates would only cover
+    part of it.
+
+    Args:
+        interval (int): Length of the time windows, in seconds.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.window = None
+        self.partial = True
+        self._reset()
+
+    def _reset(self):
+        self.count = 0
+        self.latency = []
+        self.total_drop = 0.0
+        self.count_full_drop = 0
+        self.downlink_bits = 0.0
+        self.uplink_bits = 0.0
+        self.count_obstructed = 0
+        self.count_unscheduled = 0
+
+    def _finish(self):
+        latency = sorted(self.latency)
+        fields = {
+            "samples": self.count,
+            "ping_drop_rate": self.total_drop / self.count,
+            "count_full_ping_drop": self.count_full_drop,
+            "downlink_bits": self.downlink_bits,
+            "uplink_bits": self.uplink_bits,
+            "count_obstructed": self.count_obstructed,
+            "count_unscheduled": self.count_unscheduled,
+        }
+        if latency:
+            fields.update({
+                "min_ping_latency_ms": latency[0],
+                "mean_ping_latency_ms": sum(latency) / len(latency),
+                "max_ping_latency_ms": latency[-1],
+                "p95_ping_latency_ms": _percentile(latency, 0.95),
+            })
+        return self.window, fields
+
+    def add(self, bulk, count, timestamp):
+        """Add bulk history samples.
+
+        Args:
+            bulk (dict): Bulk history data, as passed to the add_bulk call
+                back by get_data.
+            count (int): Number of samples in bulk.
+            timestamp (int): Time of the sample prior to the first one in
+                bulk, as passed to the add_bulk call back by get_data.
+
+        Returns:
+            A list of (timestamp, fields) tuples, one for each window
+            completed by the samples added, where timestamp is the time of
+            the start of the window and fields is a dict mapping aggregate
+            value names to their values.
+        """
+        windows = []
+        drop_rates = bulk["pop_ping_drop_rate"]
+        latencies = bulk["pop_ping_latency_ms"]
+        downlink = bulk["downlink_throughput_bps"]
+        uplink = bulk["uplink_throughput_bps"]
+        scheduled = bulk["scheduled"]
+        obstructed = bulk["obstructed"]
+        for i in range(count):
+            timestamp += 1
+            window = timestamp - timestamp % self.interval
+            if window != self.window:
+                if self.count and not self.partial:
+                    windows.append(self._finish())
+                self.partial = self.window is None and window != timestamp
+                self.window = window
+                self._reset()
+            self.count += 1
+            drop = drop_rates[i]
+            self.total_drop += drop
+            if drop >= 1:
+                self.count_full_drop += 1
+            if latencies[i] is not None:
+                self.latency.append(latencies[i])
+            self.downlink_bits += downlink[i]
+            self.uplink_bits += uplink[i]
+            # count the same way as the ping drop history stats do
+            if not scheduled[i]:
+                self.count_unscheduled += 1
+            elif obstructed[i]:
+                self.count_obstructed += 1
+        return windows
+
+
+def _outage_cause(scheduled, obstructed):
+    # classify the same way as the ping drop history stats do
+    if not scheduled:
+        return "unscheduled"
+    if obstructed:
+        return "obstructed"
+    return "other"
+
+
+class OutageTracker:
+    """Detect outages in history data incrementally across polls.
+
+    An outage is a run of consecutive samples with full ping drop. The cause
+    of an outage is whichever of "unscheduled", "obstructed", or "other" was
+    the case for the most samples in the run. Runs are tracked across polls
+    using the sample counter, so an outage that spans more than one poll is
+    reported as a single outage. If samples were lost between polls, an
+    outage in progress is considered to have ended at the last sample seen.
+    """
     def __init__(self):
+        self.counter = None
+        self._reset()
+
+    def _reset(self):
+        self.start = None
+        self.length = 0
+        self.causes = {"unscheduled": 0, "obstructed": 0, "other": 0}
+
+    def _cause(self):
+        return max(self.causes, key=self.causes.get)
+
+    def _end(self, events):
+        events.append(("end", self.start, self.length, self._cause()))
+        self._reset()
+
+    def update(self, bulk, count, end_counter, timestamp):
+        """Process new history samples.
+
+        Args:
+            bulk (dict): Bulk history data, as returned by
+                starlink_grpc.history_bulk_data.
+            count (int): Number of samples in bulk.
+            end_counter (int): Sample counter value after the last sample in
+                bulk.
+            timestamp (int): Time of the last sample in bulk.
+
+        Returns:
+            A list of (event, start_timestamp, duration, cause) tuples, one
+            for each outage start or end event detected, where event is
+            "start" or "end", start_timestamp is the time the outage started,
+            duration is its length in seconds (so far, for start events), and
+            cause is its dominant cause. Outages that start and end within
+            the new samples get both events.
+        """
+        events = []
+        if self.counter is not None and end_counter - count != self.counter and self.length:
+            self._end(events)
+
+        drop_rates = bulk["pop_ping_drop_rate"]
+        scheduled = bulk["scheduled"]
+        obstructed = bulk["obstructed"]
+        started = False
+        for i in range(count):
+            if drop_rates[i] >= 1:
+                if not self.length:
+                    self.start = timestamp - count + 1 + i
+                    started = True
+                self.length += 1
+                self.causes[_outage_cause(scheduled[i], obstructed[i])] += 1
+            elif self.length:
+                if started:
+                    events.append(("start", self.start, self.length, self._cause()))
+                    started = False
+                self._end(events)
+        if started:
+            events.append(("start", self.start, self.length, self._cause()))
+
+        self.counter = end_counter
+        return events
+
+
+class ModeScheduler:
+    """Track which of the selected modes are due to be polled.
+
+    Args:
+        mode_intervals (dict): Mapping of mode name to loop interval, in
+            seconds, as set in options by run_arg_parser.
+        loop_interval (float): The interval at which the main loop runs. Modes
+            that will be due within half of this are considered due now, to
+            allow for scheduler timing jitter.
+    """
+    def __init__(self, mode_intervals, loop_interval):
+        self.intervals = mode_intervals
+        self.slack = loop_interval / 2.0
+        self.next_due = {}
+
+    def due_modes(self):
+        """Return the list of modes due to be polled now.
+
+        Modes returned are considered to have been polled, so will not be
+        returned again until their next interval comes due.
+        """
+        now = time.monotonic()
+        modes = []
+        for mode, interval in self.intervals.items():
+            next_due = self.next_due.get(mode, now)
+            if now + self.slack >= next_due:
+                modes.append(mode)
+                self.next_due[mode] = max(next_due + interval, now)
+        return modes
+
+
+class GlobalState:
+    """A class for keeping state across loop iterations.
+
+    Args:
+        opts (object): Optionally, the options object returned from
+            run_arg_parser, to configure the dish connection. If not set, no
+            time limits are applied to requests to the dish.
+    """
+    def __init__(self, opts=None):
         self.counter = None
         self.timestamp = None
+        self.saved_state = None
         self.dish_id = None
-        self.context = starlink_grpc.ChannelContext()
+        self.bulk_scheduler = None
+        self.mode_scheduler = None
+        self.outage_tracker = None
+        self.last_values = {}
+        self.next_heartbeat = None
+        # Caching responses avoids fetching the history data more than once
+        # per loop iteration when more than one history mode is selected.
+        if opts is None:
+            self.context = starlink_grpc.ChannelContext(cache=True)
+        else:
+            # When running in a loop, fail fast while the dish is not
+            # reachable, so each loop iteration does not wait out the time
+            # limit on every request.
+            looping = opts.loop_interval > 0.0
+            timeout = opts.rpc_timeout if opts.rpc_timeout > 0.0 else None
+            self.context = starlink_grpc.ChannelContext(
+                cache=True,
+                timeout=timeout,
+                keepalive=RPC_KEEPALIVE if timeout is None or timeout > RPC_KEEPALIVE else None,
+                retries=max(opts.rpc_retries, 0),
+                breaker_threshold=BREAKER_THRESHOLD if looping else None,
+                breaker_reset=BREAKER_RESET)
 
     def shutdown(self):
         self.context.close()
 
 
-def get_data(opts, gstate, add_item, add_sequence, add_bulk=None):
+def get_data(opts, gstate, add_item, add_sequence, add_bulk=None, add_outage=None, keep_id=False):
     """Fetch data from the dish, pull it apart and call back with the pieces.
 
     This function uses call backs to return the useful data. If need_id is set
@@ -149,10 +626,22 @@ def get_data(opts, gstate, add_item, add_sequence, add_bulk=None):
             prototype:
 
             add_bulk(bulk_data, count, start_timestamp, start_counter)
+        add_outage (function): Optional. Call back for outage events, with
+            prototype:
+
+            add_outage(event, start_timestamp, duration, cause)
+
+            See OutageTracker.update for detail.
+        keep_id (bool): Optional. If set, the id field is passed to add_item
+            with the rest of the status data even if need_id is set, instead
+            of being removed from it.
 
     Returns:
         1 if there were any failures getting data from the dish, otherwise 0.
     """
+    if opts.changes_only:
+        add_item, add_sequence = filter_changes(opts, gstate, add_item, add_sequence)
+
     def add_data(data, category):
         for key, val in data.items():
             name, start, seq = BRACKETS_RE.match(key).group(1, 4, 5)
@@ -161,29 +650,48 @@ def get_data(opts, gstate, add_item, add_sequence, add_bulk=None):
             else:
                 add_sequence(name, val, category, int(start) if start else 0)
 
-    if opts.satus_mode:
+    if len(set(opts.mode_intervals.values())) > 1:
+        if gstate.mode_scheduler is None:
+            gstate.mode_scheduler = ModeScheduler(opts.mode_intervals, opts.loop_interval)
+        modes = gstate.mode_scheduler.due_modes()
+    else:
+        modes = opts.mode
+    status_mode = bool(set(STATUS_MODES).intersection(modes))
+    ping_mode = bool(set(PING_MODES).intersection(modes))
+    bulk_mode = "bulk_history" in modes
+    outage_mode = "outages" in modes
+
+    # The history data takes longer to fetch than the status data, so if both
+    # will be needed, start fetching the history in the background now,
+    # instead of waiting until the status has been fetched.
+    if status_mode and (ping_mode or outage_mode and add_outage or bulk_mode and add_bulk and
+                        (gstate.bulk_scheduler is None or gstate.bulk_scheduler.due())):
+        starlink_grpc.prefetch(gstate.context, ["get_history"])
+
+    if status_mode:
         try:
             status_data, obstruct_detail, alert_detail = starlink_grpc.status_data(
                 context=gstate.context)
         except starlink_grpc.GrpcError as e:
-            if "status" in opts.mode:
+            if "status" in modes:
                 if opts.need_id and gstate.dish_id is None:
                     conn_error(opts, "Dish unreachable and ID unknown, so not recording state")
                 else:
                     if opts.verbose:
                         print("Dish unreachable")
-                    if "status" in opts.mode:
+                    if "status" in modes:
                         add_item("state", "DISH_UNREACHABLE", "status")
                         return 0
             return 1
         if opts.need_id:
             gstate.dish_id = status_data["id"]
-            del status_data["id"]
-        if "status" in opts.mode:
+            if not keep_id:
+                del status_data["id"]
+        if "status" in modes:
             add_data(status_data, "status")
-        if "obstruction_detail" in opts.mode:
+        if "obstruction_detail" in modes:
             add_data(obstruct_detail, "status")
-        if "alert_detail" in opts.mode:
+        if "alert_detail" in modes:
             add_data(alert_detail, "status")
     elif opts.need_id and gstate.dish_id is None:
         try:
@@ -194,21 +702,34 @@ def get_data(opts, gstate, add_item, add_sequence, add_bulk=None):
         if opts.verbose:
             print("Using dish ID: " + gstate.dish_id)
 
-    if opts.ping_mode:
+    if ping_mode:
         try:
-            general, ping, runlen = starlink_grpc.history_ping_stats(opts.samples,
-                                                                     opts.verbose,
-                                                                     context=gstate.context)
+            general, stats = starlink_grpc.history_stats(
+                opts.samples,
+                [mode for mode in starlink_grpc.HISTORY_STATS_GROUPS if mode in modes],
+                verbose=opts.verbose,
+                context=gstate.context)
         except starlink_grpc.GrpcError as e:
             conn_error(opts, "Failure getting ping stats: %s", str(e))
             return 1
         add_data(general, "ping_stats")
-        if "ping_drop" in opts.mode:
-            add_data(ping, "ping_stats")
-        if "ping_run_length" in opts.mode:
-            add_data(runlen, "ping_stats")
+        for group_stats in stats.values():
+            add_data(group_stats, "ping_stats")
+
+    if opts.adaptive_bulk and gstate.bulk_scheduler is None:
+        gstate.bulk_scheduler = BulkScheduler(opts.loop_interval)
+
+    if bulk_mode and add_bulk and (gstate.bulk_scheduler is None
+                                        or gstate.bulk_scheduler.due()):
+        if gstate.counter is None and opts.state_file:
+            state = load_state_file(opts.state_file)
+            if state.get("dish_id") == gstate.dish_id:
+                gstate.counter = state.get("end_counter")
+                gstate.timestamp = state.get("timestamp")
+                gstate.saved_state = (gstate.counter, gstate.timestamp)
+                if opts.verbose and gstate.counter is not None:
+                    print("Resuming from saved sample counter: " + str(gstate.counter))
 
-    if opts.bulk_mode and add_bulk:
         before = time.time()
 
         start = gstate.counter
@@ -220,15 +741,22 @@ def get_data(opts, gstate, add_item, add_sequence, add_bulk=None):
                                                             context=gstate.context)
         except starlink_grpc.GrpcError as e:
             conn_error(opts, "Failure getting history: %s", str(e))
+            if gstate.bulk_scheduler is not None:
+                gstate.bulk_scheduler.poll_failed()
             return 1
 
         after = time.time()
         parsed_samples = general["samples"]
         new_counter = general["end_counter"]
         timestamp = gstate.timestamp
+        lost_samples = 0
         # check this first, so it doesn't report as lost time sync
         if gstate.counter is not None and new_counter != gstate.counter + parsed_samples:
             timestamp = None
+            if new_counter > gstate.counter:
+                lost_samples = new_counter - parsed_samples - gstate.counter
+                if opts.verbose:
+                    print("Lost {0} samples from history buffer".format(lost_samples))
         # Allow up to 2 seconds of time drift before forcibly re-syncing, since
         # +/- 1 second can happen just due to scheduler timing.
         if timestamp is not None and not before - 2.0 <= timestamp + parsed_samples <= after + 2.0:
@@ -248,4 +776,120 @@ def get_data(opts, gstate, add_item, add_sequence, add_bulk=None):
         gstate.counter = new_counter
         gstate.timestamp = timestamp + parsed_samples
 
+        if gstate.bulk_scheduler is not None:
+            gstate.bulk_scheduler.poll_succeeded(parsed_samples, lost_samples)
+            if opts.verbose:
+                print("Next history poll in {0} seconds".format(
+                    round(gstate.bulk_scheduler.next_poll - time.monotonic())))
+
+    if outage_mode and add_outage:
+        if gstate.outage_tracker is None:
+            gstate.outage_tracker = OutageTracker()
+        start = gstate.outage_tracker.counter
+        parse_samples = opts.samples if start is None else -1
+        try:
+            # If bulk mode is also in use, this reuses the cached history
+            general, bulk = starlink_grpc.history_bulk_data(parse_samples,
+                                                            start=start,
+                                                            verbose=opts.verbose,
+                                                            context=gstate.context)
+        except starlink_grpc.GrpcError as e:
+            conn_error(opts, "Failure getting history: %s", str(e))
+            return 1
+        for event in gstate.outage_tracker.update(bulk, general["samples"],
+                                                  general["end_counter"], int(time.time())):
+            if opts.verbose:
+                print("Outage {0}: {1}, {2} seconds, cause: {3}".format(
+                    event[0], datetime.fromtimestamp(event[1], tz=timezone.utc), event[2],
+                    event[3]))
+            add_outage(*event)
+
     return 0
+
+
+class PolledData:
+    """Record the call backs from one get_data call for replay to other users.
+
+    This allows a single poll of the dish to feed multiple output sinks. The
+    get_data method has the same prototype as the get_data function in this
+    module, so it can be passed in its place to the loop_body function of any
+    of the dish_grpc_* scripts.
+    """
+    def __init__(self):
+        self.calls = []
+        self.dish_id = None
+        self.counter = None
+        self.timestamp = None
+        self.rc = 0
+
+    def poll(self, opts, gstate):
+        """Fetch data from the dish and record the results.
+
+        Args:
+            opts (object): The options object returned from run_arg_parser.
+            gstate (GlobalState): The state object used for polling the dish.
+
+        Returns:
+            The return code from get_data.
+        """
+        calls = []
+
+        def add_item(name, val, category):
+            calls.append(("item", (name, val, category)))
+
+        def add_sequence(name, val, category, start):
+            calls.append(("sequence", (name, val, category, start)))
+
+        def add_bulk(bulk, count, timestamp, counter):
+            calls.append(("bulk", (bulk, count, timestamp, counter)))
+
+        def add_outage(event, timestamp, duration, cause):
+            calls.append(("outage", (event, timestamp, duration, cause)))
+
+        # Users that do not need the id still expect to see it in the status
+        # data, so keep it there and remove it on replay for those that do.
+        self.rc = get_data(opts,
+                           gstate,
+                           add_item,
+                           add_sequence,
+                           add_bulk=add_bulk,
+                           add_outage=add_outage,
+                           keep_id=True)
+        self.calls = calls
+        self.dish_id = gstate.dish_id
+        self.counter = gstate.counter
+        self.timestamp = gstate.timestamp
+        return self.rc
+
+    def get_data(self, opts, gstate, add_item, add_sequence, add_bulk=None, add_outage=None):
+        """Replay the most recently polled data to the given call backs.
+
+        See get_data for detail on the args and return value. Note that
+        the data replayed is determined by the options used when polling, not
+        by opts, except that bulk data and outage events will only be
+        replayed if add_bulk and add_outage, respectively, are set, and
+        unchanged values will be filtered out if the changes_only option is
+        set.
+
+        The bulk history sample counter and time base are copied into gstate,
+        the same as get_data would leave them.
+        """
+        if self.dish_id is not None:
+            gstate.dish_id = self.dish_id
+        gstate.counter = self.counter
+        gstate.timestamp = self.timestamp
+        if opts.changes_only:
+            add_item, add_sequence = filter_changes(opts, gstate, add_item, add_sequence)
+        for kind, args in self.calls:
+            if kind == "item":
+                if args[0] == "id" and args[2] == "status" and opts.need_id:
+                    continue
+                add_item(*args)
+            elif kind == "sequence":
+                add_sequence(*args)
+            elif kind == "bulk":
+                if add_bulk:
+                    add_bulk(*args)
+            elif add_outage:
+                add_outage(*args)
+        return self.rc
@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+"""Send Starlink user terminal data to multiple output targets at once.
+
+This script pulls the current status info and/or metrics computed from the
+history data once per loop iteration and passes the results to any
+combination of the InfluxDB, MQTT, sqlite, snapshot file, and text output
+implemented by the other dish_grpc_* scripts. This avoids having to run one process per output, each
+of which would poll the dish separately.
+
+Each output target is configured using the same options as the corresponding
+script, passed as a single argument. For example:
+
+    dish_grpc_fanout.py -t 1 --influx="-n influx.local -D starlink" \\
+        --mqtt="-n broker.local" --text= status ping_drop
+
+Note the use of "=" to keep the option arguments from being interpreted as
+options to this script.
+
+Options that control how the dish is polled, such as --rpc-timeout,
+--rpc-retries, --adaptive-bulk, and --state-file, must be passed to this
+script directly, since that's where the polling happens. They will be
+rejected if included in the options for an output target. The state file is
+only saved when the script exits, and only if all output targets finished
+writing their data without error.
+
+Each output target keeps its own state, so data batching is done per target
+and a failure writing to one target does not affect the others.
+"""
+
+import logging
+import shlex
+import signal
+import sys
+import time
+
+import dish_common
+
+
+class Terminated(Exception):
+    pass
+
+
+def handle_sigterm(signum, frame):
+    # Turn SIGTERM into an exception so main loop can clean up
+    raise Terminated
+
+
+class Sink:
+    """An output target, along with the options and state it uses."""
+    def __init__(self, name, module, opts):
+        self.name = name
+        self.module = module
+        self.opts = opts
+        self.gstate = dish_common.GlobalState()
+        self.rc = 0
+
+
+def parse_args():
+    parser = dish_common.create_arg_parser(
+        output_description="send it to one or more of the output targets supported by the other "
+        "dish_grpc_* scripts",
+        outages=True)
+
+    group = parser.add_argument_group(title="Output target options")
+    group.add_argument("--influx",
+                       metavar="ARGS",
+                       help="Write to an InfluxDB database, using the dish_grpc_influx.py options "
+                       "in ARGS, passed as a single argument")
+    group.add_argument("--mqtt",
+                       metavar="ARGS",
+                       help="Publish to a MQTT broker, using the dish_grpc_mqtt.py options in "
+                       "ARGS, passed as a single argument")
+    group.add_argument("--sqlite",
+                       metavar="ARGS",
+                       help="Write to a sqlite database, using the dish_grpc_sqlite.py options in "
+                       "ARGS, passed as a single argument")
+    group.add_argument("--snapshot",
+                       metavar="ARGS",
+                       help="Write to a shared memory snapshot file, using the "
+                       "dish_grpc_snapshot.py options in ARGS, passed as a single argument")
+    group.add_argument("--text",
+                       metavar="ARGS",
+                       help="Print to standard output, using the dish_grpc_text.py options in "
+                       "ARGS, passed as a single argument")
+
+    opts = dish_common.run_arg_parser(parser, no_stdout_errors=True)
+
+    if all(
+            getattr(opts, target) is None
+            for target in ["influx", "mqtt", "sqlite", "snapshot", "text"]):
+        parser.error("At least one output target must be selected")
+
+    common_args = ["-t", str(opts.loop_interval)]
+    if opts.verbose:
+        common_args.append("-v")
+    if opts.changes_only:
+        common_args.extend(["--changes-only", "--heartbeat", str(opts.heartbeat)])
+
+    def sink_args(name, args, unsupported=()):
+        modes = [mode for mode in opts.mode if mode not in unsupported]
+        if not modes:
+            parser.error(name + " output does not support any of the selected modes")
+        # The loop interval has already been replaced by the shortest of the
+        # mode intervals, so pass every mode's interval explicitly, to keep
+        # the original one for modes that did not have their own.
+        interval_args = []
+        if opts.loop_interval > 0.0:
+            for mode in modes:
+                interval_args.extend(["-i", "{0}={1}".format(mode, opts.mode_intervals[mode])])
+        return shlex.split(args) + common_args + interval_args + ["--"] + modes
+
+    def add_sink(name, module, args, unsupported=()):
+        sink_opts = module.parse_args(sink_args(name, args, unsupported))
+        # These are only used when polling the dish, which the output targets
+        # don't do, so would otherwise be silently ignored.
+        if (sink_opts.rpc_timeout != dish_common.RPC_TIMEOUT_DEFAULT
+                or sink_opts.rpc_retries != dish_common.RPC_RETRIES_DEFAULT
+                or getattr(sink_opts, "adaptive_bulk", False)
+                or getattr(sink_opts, "state_file", None) is not None):
+            parser.error(name + " output options cannot include --rpc-timeout, --rpc-retries, "
+                         "--adaptive-bulk, or --state-file; use them as options to this script "
+                         "instead")
+        opts.sinks.append(Sink(name, module, sink_opts))
+
+    opts.sinks = []
+    if opts.influx is not None:
+        import dish_grpc_influx
+        add_sink("InfluxDB", dish_grpc_influx, opts.influx)
+    if opts.mqtt is not None:
+        import dish_grpc_mqtt
+        add_sink("MQTT", dish_grpc_mqtt, opts.mqtt, ["bulk_history"])
+    if opts.sqlite is not None:
+        import dish_grpc_sqlite
+        add_sink("sqlite", dish_grpc_sqlite, opts.sqlite, ["outages"])
+    if opts.snapshot is not None:
+        import dish_grpc_snapshot
+        add_sink("Snapshot", dish_grpc_snapshot, opts.snapshot, ["outages"])
+    if opts.text is not None:
+        import dish_grpc_text
+        add_sink("Text", dish_grpc_text, opts.text, ["outages"])
+
+    # unchanged values are filtered separately for each output target, since
+    # they may have different options for that
+    opts.changes_only = False
+    # dish ID is needed if any of the output targets need it, or for the
+    # state file
+    opts.need_id = opts.need_id or any(sink.opts.need_id for sink in opts.sinks)
+    # text output goes to stdout, so only protect it if that's in use
+    opts.no_stdout_errors = opts.text is not None
+
+    return opts
+
+
+def loop_body(opts, gstate, polled):
+    polled.poll(opts, gstate)
+
+    rc = 0
+    for sink in opts.sinks:
+        try:
+            sink.rc = sink.module.loop_body(sink.opts, sink.gstate, get_data=polled.get_data)
+        except Exception as e:
+            # Don't let a failure in one output target affect the others
+            logging.error("Unexpected error in %s output: %s", sink.name, str(e))
+            sink.rc = 1
+        rc = max(rc, sink.rc)
+
+    return rc
+
+
+def main():
+    opts = parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    gstate = dish_common.GlobalState(opts)
+    polled = dish_common.PolledData()
+
+    for sink in opts.sinks:
+        if hasattr(sink.module, "setup"):
+            sink.module.setup(sink.opts, sink.gstate)
+        if getattr(sink.opts, "print_header", False):
+            sink.module.print_header(sink.opts, sink.gstate.out)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    rc = 0
+    try:
+        next_loop = time.monotonic()
+        while True:
+            rc = loop_body(opts, gstate, polled)
+            if opts.loop_interval > 0.0:
+                now = time.monotonic()
+                next_loop = max(next_loop + opts.loop_interval, now)
+                time.sleep(next_loop - now)
+            else:
+                break
+    except Terminated:
+        pass
+    finally:
+        for sink in opts.sinks:
+            if hasattr(sink.module, "shutdown"):
+                rc = max(rc, sink.module.shutdown(sink.opts, sink.gstate))
+        # Some output targets only write their data on shutdown, so this is
+        # the only point at which it's known to have all been written.
+        if rc == 0:
+            dish_common.save_bulk_state(opts, gstate)
+        gstate.shutdown()
+
+    sys.exit(rc)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,11 @@ This script pulls the current status info and/or metrics computed from the
 history data and writes them to the specified InfluxDB database either once
 or in a periodic loop.
 
+The same data can also be written to additional InfluxDB databases, possibly
+on other servers, using the --replica option. Each database gets its own
+write queue and its own writer thread, so a slow or unreachable one does not
+hold up writes to the others.
+
 NOTE: The Starlink user terminal does not include time values with its
 history or status data, so this script uses current system time to compute
 the timestamps it sends to InfluxDB. It is recommended to run this script on
@@ -12,28 +17,40 @@ a host that has its system clock synced via NTP. Otherwise, the timestamps
 may get out of sync with real time.
 """
 
+import argparse
 import logging
+import math
 import os
+import queue
+import shlex
 import signal
 import sys
+import threading
 import time
 import warnings
 from datetime import datetime
 from datetime import timezone
 
-from influxdb_client.client.write_api import Point
-# from influxdb_client import InfluxDBClient
-from influxdb_client.client.write_api import SYNCHRONOUS
-from influxdb_client.domain.write_precision import WritePrecision
-
 import dish_common
 
 HOST_DEFAULT = "localhost"
 DATABASE_DEFAULT = "starlink"
 BULK_MEASUREMENT = "spacex.starlink.user_terminal.history"
+ROLLUP_MEASUREMENT = "spacex.starlink.user_terminal.history_rollup"
+COMPACTED_MEASUREMENT = "spacex.starlink.user_terminal.history_compacted"
+OUTAGE_MEASUREMENT = "spacex.starlink.user_terminal.outage"
 FLUSH_LIMIT = 6
 MAX_BATCH = 5000
+MIN_BATCH = 100
+# Writes that take longer than this many seconds cause the batch size to be
+# reduced, and ones that take much less allow it to grow back.
+BATCH_TARGET_TIME = 2.0
 MAX_QUEUE_LENGTH = 864000
+# When writes are failing and the queue grows past this many points, which
+# is 1 day of bulk data, the oldest bulk data points start getting compacted
+# into per-minute aggregates, up to COMPACT_CHUNK points per loop iteration.
+COMPACT_THRESHOLD = 86400
+COMPACT_CHUNK = 3600
 
 
 class Terminated(Exception):
@@ -45,10 +62,39 @@ def handle_sigterm(signum, frame):
     raise Terminated
 
 
-def parse_args():
-    parser = dish_common.create_arg_parser(output_description="write it to an InfluxDB database")
-
-    group = parser.add_argument_group(title="InfluxDB database options")
+class Destination:
+    """An InfluxDB database to write to, along with its queue of data points.
+
+    Each destination has its own queue and batch size, so that failures or
+    slowness writing to one do not affect the others. When there is more than
+    one, each is written to from its own writer thread, which takes new data
+    points from the incoming queue.
+
+    Args:
+        name (str): Description of the database, for use in log messages.
+        icargs (dict): Keyword arguments for creating the InfluxDB client.
+        retention_policy (str): Optionally, the retention policy to write to.
+        batch_size (int): Maximum number of data points to write at once.
+    """
+    def __init__(self, name, icargs, retention_policy, batch_size):
+        self.name = name
+        self.icargs = icargs
+        self.retention_policy = retention_policy
+        self.batch_size = batch_size
+        self.batch_limit = batch_size
+        # list of (point, line) pairs, where line is the point serialized to
+        # line protocol, which is shared between all destinations
+        self.points = []
+        # number of queued points at the front that have already been compacted
+        self.compacted = 0
+        self.influx_client = None
+        self.write_api = None
+        self.incoming = None
+        self.writer = None
+        self.rc = 0
+
+
+def add_database_args(group):
     group.add_argument("-n",
                        "--hostname",
                        default=HOST_DEFAULT,
@@ -65,10 +111,13 @@ def parse_args():
                        default=DATABASE_DEFAULT,
                        help="Database/Bucket name to use, default: " + DATABASE_DEFAULT)
     group.add_argument("-R", "--retention-policy", help="Retention policy name to use")
-    group.add_argument("-k",
-                       "--skip-query",
-                       action="store_true",
-                       help="Skip querying for prior sample write point in bulk mode")
+    group.add_argument("--batch-size",
+                       type=int,
+                       default=MAX_BATCH,
+                       help="Maximum number of data points to write per request; reduced "
+                       "automatically if writes are slow or rejected as too large, default: " +
+                       str(MAX_BATCH),
+                       metavar="N")
     group.add_argument("-C",
                        "--ca-cert",
                        dest="verify_ssl",
@@ -85,6 +134,63 @@ def parse_args():
                        dest="verify_ssl",
                        help="Enable SSL/TLS using default CA cert")
 
+
+def check_database_args(parser, opts):
+    if opts.username is None and opts.password is not None:
+        parser.error("Password authentication requires username to be set")
+    if opts.batch_size < MIN_BATCH:
+        parser.error("Batch size must be at least " + str(MIN_BATCH))
+
+    opts.icargs = {"timeout": 5}
+    for key in ["port", "host", "url", "password", "username", "database", "org", "token", "verify_ssl"]:
+        val = getattr(opts, key)
+        if val is not None:
+            opts.icargs[key] = val
+
+    if opts.verify_ssl is not None:
+        opts.icargs["ssl"] = True
+
+
+def parse_replica_args(parser, args):
+    replica_parser = argparse.ArgumentParser(prog=parser.prog + " --replica",
+                                             description="Options for a replica database")
+    add_database_args(replica_parser.add_argument_group(title="InfluxDB database options"))
+    replica_opts = replica_parser.parse_args(shlex.split(args))
+    check_database_args(replica_parser, replica_opts)
+    return replica_opts
+
+
+def parse_args(args=None):
+    parser = dish_common.create_arg_parser(output_description="write it to an InfluxDB database",
+                                           outages=True)
+
+    group = parser.add_argument_group(title="InfluxDB database options")
+    add_database_args(group)
+    group.add_argument("--replica",
+                       action="append",
+                       default=[],
+                       help="Also write to another InfluxDB database, using the database options "
+                       "in ARGS, passed as a single argument. May be used multiple times",
+                       metavar="ARGS")
+    group.add_argument("-k",
+                       "--skip-query",
+                       action="store_true",
+                       help="Skip querying for prior sample write point in bulk mode")
+    group.add_argument("--checkpoint-file",
+                       help="In bulk mode, record the last sample written to the database in this "
+                       "file, and use that instead of querying the database, if possible, to find "
+                       "the prior sample write point",
+                       metavar="FILENAME")
+    group.add_argument("--rollup",
+                       type=int,
+                       help="In bulk mode, also write aggregate values over windows of this many "
+                       "seconds, such as min/mean/max latency, to a separate measurement",
+                       metavar="SECONDS")
+    group.add_argument("--rollup-only",
+                       action="store_true",
+                       help="In bulk mode, write only the aggregate values set by --rollup, and "
+                       "not the per-second samples")
+
     env_map = (
         ("INFLUXDB_HOST", "host"),
         ("INFLUXDB_PORT", "port"),
@@ -110,65 +216,324 @@ def parse_args():
                 env_defaults[opt] = val
     parser.set_defaults(**env_defaults)
 
-    opts = dish_common.run_arg_parser(parser, need_id=True)
+    opts = dish_common.run_arg_parser(parser, need_id=True, args=args)
 
-    if opts.username is None and opts.password is not None:
-        parser.error("Password authentication requires username to be set")
+    check_database_args(parser, opts)
 
-    opts.icargs = {"timeout": 5}
-    for key in ["port", "host", "url", "password", "username", "database", "org", "token", "verify_ssl"]:
-        val = getattr(opts, key)
-        if val is not None:
-            opts.icargs[key] = val
+    if opts.rollup is not None and opts.rollup <= 0:
+        parser.error("Rollup window must be a positive number of seconds")
+    if opts.rollup_only and opts.rollup is None:
+        parser.error("--rollup-only requires --rollup to be set")
 
-    if opts.verify_ssl is not None:
-        opts.icargs["ssl"] = True
+    opts.replicas = [parse_replica_args(parser, args) for args in opts.replica]
 
     return opts
 
 
-def flush_points(opts, gstate):
-    try:
-        while len(gstate.points) > MAX_BATCH:
-            if 'token' not in opts.icargs:
-                gstate.influx_client.write_points(gstate.points[:MAX_BATCH],
-                                                  time_precision="s",
-                                                  retention_policy=opts.retention_policy)
-            else:
-                points = [Point.from_dict(i, write_precision=WritePrecision.S) for i in gstate.points[:MAX_BATCH]]
-                gstate.influx_client.write_api(write_options=SYNCHRONOUS).write(opts.icargs['database'],
-                                                                                opts.icargs['org'],
-                                                                                points)
-            if opts.verbose:
-                print("Data points written: " + str(MAX_BATCH))
-            del gstate.points[:MAX_BATCH]
-        if gstate.points:
-            if 'token' not in opts.icargs:
-                gstate.influx_client.write_points(gstate.points,
-                                                  time_precision="s",
-                                                  retention_policy=opts.retention_policy)
-            else:
-                points = [Point.from_dict(i, write_precision=WritePrecision.S) for i in gstate.points]
-                gstate.influx_client.write_api(write_options=SYNCHRONOUS).write(opts.icargs['database'],
-                                                                                opts.icargs['org'],
-                                                                                points)
+def database_name(opts):
+    if opts.url is not None:
+        server = opts.url
+    elif opts.port is not None:
+        server = "{0}:{1}".format(opts.host, opts.port)
+    else:
+        server = opts.host
+    return server + "/" + opts.database
+
+
+def escape_key(key):
+    key = str(key).replace("\\", "\\\\")
+    return key.replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def line_protocol(point):
+    """Serialize a data point to InfluxDB line protocol, with time in seconds.
+
+    Returns:
+        The line of text, or None if the data point has no field values that
+        can be written.
+    """
+    fields = []
+    for key, val in point["fields"].items():
+        if val is None:
+            continue
+        if isinstance(val, bool):
+            val = "true" if val else "false"
+        elif isinstance(val, int):
+            val = str(val) + "i"
+        elif isinstance(val, float):
+            if not math.isfinite(val):
+                continue
+            val = repr(val)
+        else:
+            val = '"' + str(val).replace("\\", "\\\\").replace('"', '\\"') + '"'
+        fields.append(escape_key(key) + "=" + val)
+    if not fields:
+        return None
+
+    tags = "".join(
+        "," + escape_key(key) + "=" + escape_key(val)
+        for key, val in sorted(point["tags"].items())
+        if val is not None and val != "")
+    return "{0}{1} {2} {3}".format(point["measurement"].replace(",", "\\,").replace(" ", "\\ "),
+                                   tags, ",".join(fields), int(point["time"]))
+
+
+def write_batch(dest, lines):
+    if 'token' not in dest.icargs:
+        dest.influx_client.write_points(lines,
+                                        time_precision="s",
+                                        retention_policy=dest.retention_policy,
+                                        protocol="line")
+    else:
+        from influxdb_client.domain.write_precision import WritePrecision
+
+        dest.write_api.write(dest.icargs['database'],
+                             dest.icargs['org'],
+                             lines,
+                             write_precision=WritePrecision.S)
+
+
+def too_large(e):
+    # v1 client errors have code, v2 client errors have status
+    return getattr(e, "code", None) == 413 or getattr(e, "status", None) == 413
+
 
+def describe(dest, msg):
+    # only name the database if there is more than one
+    return msg if dest.name is None else "{0} ({1})".format(msg, dest.name)
+
+
+def adjust_batch_size(opts, dest, elapsed, count):
+    if elapsed > BATCH_TARGET_TIME:
+        batch_size = max(dest.batch_size // 2, MIN_BATCH)
+    elif count == dest.batch_size and elapsed < BATCH_TARGET_TIME / 4:
+        batch_size = min(dest.batch_size * 2, dest.batch_limit)
+    else:
+        return
+    if batch_size != dest.batch_size:
+        if opts.verbose:
+            print(describe(dest, "Changing write batch size") + " to " + str(batch_size))
+        dest.batch_size = batch_size
+
+
+def flush_points(opts, gstate, dest):
+    # Only the first database's progress is recorded in the checkpoint file,
+    # since that's the one the prior sample write point is read back from.
+    # The same goes for the state file, which only gets saved once the data
+    # has been written.
+    checkpoint = (opts.checkpoint_file or opts.state_file) and dest is gstate.destinations[0]
+    try:
+        while dest.points:
+            batch = dest.points[:dest.batch_size]
+            start = time.monotonic()
+            try:
+                write_batch(dest, [line for _, line in batch])
+            except Exception as e:
+                if too_large(e) and len(batch) > MIN_BATCH:
+                    # don't grow back to a size the server won't accept
+                    dest.batch_limit = max(len(batch) // 2, MIN_BATCH)
+                    dest.batch_size = dest.batch_limit
+                    if opts.verbose:
+                        print(
+                            describe(dest, "Write too large, reducing batch size") + " to " +
+                            str(dest.batch_size))
+                    continue
+                raise
+            adjust_batch_size(opts, dest, time.monotonic() - start, len(batch))
             if opts.verbose:
-                print("Data points written: " + str(len(gstate.points)))
-            gstate.points.clear()
+                print(describe(dest, "Data points written") + ": " + str(len(batch)))
+            del dest.points[:len(batch)]
+            dest.compacted = max(dest.compacted - len(batch), 0)
+            if checkpoint:
+                update_checkpoint(gstate, batch)
     except Exception as e:
-        dish_common.conn_error(opts, "Failed writing to InfluxDB database: %s", str(e))
-        # If failures persist, don't just use infinite memory. Max queue
-        # is currently 10 days of bulk data, so something is very wrong
-        # if it's ever exceeded.
-        if len(gstate.points) > MAX_QUEUE_LENGTH:
-            logging.error("Max write queue exceeded, discarding data.")
-            del gstate.points[:-MAX_QUEUE_LENGTH]
+        dish_common.conn_error(opts, describe(dest, "Failed writing to InfluxDB database") + ": %s",
+                               str(e))
+        # If failures persist, don't just use infinite memory. Compacting
+        # old bulk data keeps coarse history around for a long time, but
+        # max queue is still enforced as a last resort, in case something is
+        # very wrong.
+        if len(dest.points) > COMPACT_THRESHOLD:
+            compact_points(opts, dest)
+        if len(dest.points) > MAX_QUEUE_LENGTH:
+            logging.error(describe(dest, "Max write queue exceeded") + ", discarding data.")
+            del dest.points[:-MAX_QUEUE_LENGTH]
+            dest.compacted = 0
         return 1
+    finally:
+        if checkpoint:
+            if opts.checkpoint_file:
+                save_checkpoint(opts, gstate)
+            if gstate.checkpoint is not None:
+                dish_common.save_bulk_state(opts, gstate, *gstate.checkpoint)
 
     return 0
 
 
+def add_points(opts, gstate, dest, entries):
+    dest.points.extend(entries)
+    if opts.verbose:
+        print(describe(dest, "Data points queued") + ": " + str(len(dest.points)))
+    if len(dest.points) >= FLUSH_LIMIT:
+        return flush_points(opts, gstate, dest)
+    return 0
+
+
+def queue_points(opts, gstate):
+    """Pass the data points from this loop iteration on to each database.
+
+    Each data point is serialized only once, no matter how many databases it
+    gets written to.
+
+    Returns:
+        1 if there was a failure writing to any of the databases, otherwise 0.
+        For databases that have their own writer thread, this is the result
+        of the most recent write attempt.
+    """
+    entries = []
+    for point in gstate.points:
+        line = line_protocol(point)
+        if line is not None:
+            entries.append((point, line))
+    gstate.points.clear()
+
+    rc = 0
+    for dest in gstate.destinations:
+        if dest.writer is not None:
+            dest.incoming.put(entries)
+            rc = max(rc, dest.rc)
+        else:
+            rc = max(rc, add_points(opts, gstate, dest, entries))
+
+    return rc
+
+
+def run_writer(opts, gstate, dest):
+    stopping = False
+    while not stopping:
+        # pick up everything that arrived while the prior write was going on
+        new_entries = []
+        entries = dest.incoming.get()
+        while True:
+            if entries is None:
+                stopping = True
+                break
+            new_entries.extend(entries)
+            try:
+                entries = dest.incoming.get_nowait()
+            except queue.Empty:
+                break
+        try:
+            if not stopping:
+                dest.rc = add_points(opts, gstate, dest, new_entries)
+            else:
+                dest.points.extend(new_entries)
+                if dest.points:
+                    dest.rc = flush_points(opts, gstate, dest)
+        except Exception as e:
+            # Don't let a failure take down the writer thread for good
+            logging.error("Unexpected error writing to %s: %s", dest.name, str(e))
+            dest.rc = 1
+
+
+def compact_bulk_points(minute, points):
+    fields = {"samples": len(points)}
+    values = {}
+    for point in points:
+        for key, val in point["fields"].items():
+            if key != "counter":
+                values.setdefault(key, []).append(val)
+    for key, vals in values.items():
+        fields[key + "_min"] = min(vals)
+        fields[key + "_mean"] = sum(vals) / len(vals)
+        fields[key + "_max"] = max(vals)
+    return {
+        "measurement": COMPACTED_MEASUREMENT,
+        "tags": points[0]["tags"],
+        "time": minute,
+        "fields": fields,
+    }
+
+
+def compact_points(opts, dest):
+    """Compact the oldest queued bulk data points into per-minute aggregates.
+
+    Each call only processes COMPACT_CHUNK points, starting where the prior
+    call left off, so as not to hold up the loop for long.
+    """
+    start = dest.compacted
+    end = min(start + COMPACT_CHUNK, len(dest.points))
+    # The minute that continues past the end of this chunk is left for the
+    # next call, so it doesn't get split into 2 aggregate points with the
+    # same time.
+    next_point = dest.points[end][0] if end < len(dest.points) else None
+    skip_minute = None
+    if next_point is not None and next_point["measurement"] == BULK_MEASUREMENT:
+        skip_minute = next_point["time"] - next_point["time"] % 60
+
+    compacted = []
+    minutes = {}
+    resume = None
+    for entry in dest.points[start:end]:
+        point = entry[0]
+        if point["measurement"] == BULK_MEASUREMENT:
+            minute = point["time"] - point["time"] % 60
+            if minute == skip_minute:
+                if resume is None:
+                    resume = len(compacted)
+            else:
+                if minute not in minutes:
+                    minutes[minute] = []
+                    # placeholder, to keep the points in time order
+                    compacted.append(minute)
+                minutes[minute].append(point)
+                continue
+        compacted.append(entry)
+
+    for i, entry in enumerate(compacted):
+        if isinstance(entry, int):
+            point = compact_bulk_points(entry, minutes[entry])
+            compacted[i] = (point, line_protocol(point))
+    dest.points[start:end] = compacted
+    dest.compacted = start + (len(compacted) if resume is None else resume)
+    if opts.verbose:
+        print(
+            describe(dest, "Compacted {0} queued data points into {1}".format(
+                end - start, len(compacted))))
+
+
+def update_checkpoint(gstate, entries):
+    for point, _ in reversed(entries):
+        if point["measurement"] == BULK_MEASUREMENT and "counter" in point["fields"]:
+            gstate.checkpoint = (point["fields"]["counter"], point["time"])
+            return
+
+
+def save_checkpoint(opts, gstate):
+    if gstate.checkpoint is None or gstate.checkpoint == gstate.saved_checkpoint:
+        return
+    # The file may be shared by instances of this script for multiple dishes,
+    # so keep the entries for the others.
+    checkpoints = dish_common.load_state_file(opts.checkpoint_file)
+    checkpoints[gstate.dish_id] = {
+        "counter": gstate.checkpoint[0],
+        "timestamp": gstate.checkpoint[1],
+    }
+    if dish_common.save_state_file(opts.checkpoint_file, checkpoints):
+        gstate.saved_checkpoint = gstate.checkpoint
+
+
+def load_checkpoint(opts, gstate, start, end):
+    checkpoint = dish_common.load_state_file(opts.checkpoint_file).get(gstate.dish_id)
+    if isinstance(checkpoint, dict):
+        counter = checkpoint.get("counter")
+        timestamp = checkpoint.get("timestamp")
+        # same time range restriction as the database query
+        if counter and timestamp and start <= timestamp < end:
+            return int(counter), int(timestamp)
+    return None, 0
+
+
 def query_counter(gstate, start, end):
     try:
         # fetch the latest point where counter field was recorded
@@ -196,12 +561,21 @@ def query_counter(gstate, start, end):
 
 
 def sync_timebase(opts, gstate):
-    try:
-        db_counter, db_timestamp = query_counter(gstate, gstate.start_timestamp, gstate.timestamp)
-    except Exception as e:
-        # could be temporary outage, so try again next time
-        dish_common.conn_error(opts, "Failed querying InfluxDB for prior count: %s", str(e))
-        return
+    db_counter = None
+    if opts.checkpoint_file:
+        db_counter, db_timestamp = load_checkpoint(opts, gstate, gstate.start_timestamp,
+                                                   gstate.timestamp)
+        if db_counter and opts.verbose:
+            print("Resuming from checkpoint counter: " + str(db_counter))
+    if not db_counter and 'token' not in opts.icargs:
+        # The query uses InfluxQL, which is only supported by the v1 client
+        try:
+            db_counter, db_timestamp = query_counter(gstate, gstate.start_timestamp,
+                                                     gstate.timestamp)
+        except Exception as e:
+            # could be temporary outage, so try again next time
+            dish_common.conn_error(opts, "Failed querying InfluxDB for prior count: %s", str(e))
+            return
     gstate.timebase_synced = True
 
     if db_counter and gstate.start_counter <= db_counter:
@@ -235,7 +609,7 @@ def sync_timebase(opts, gstate):
     gstate.deferred_points.clear()
 
 
-def loop_body(opts, gstate):
+def loop_body(opts, gstate, get_data=dish_common.get_data):
     fields = {"status": {}, "ping_stats": {}}
 
     def cb_add_item(key, val, category):
@@ -246,6 +620,18 @@ def loop_body(opts, gstate):
             fields[category]["{0}_{1}".format(key, i)] = subval
 
     def cb_add_bulk(bulk, count, timestamp, counter):
+        if gstate.rollup is not None:
+            for window, rollup_fields in gstate.rollup.add(bulk, count, timestamp):
+                gstate.points.append({
+                    "measurement": ROLLUP_MEASUREMENT,
+                    "tags": {
+                        "id": gstate.dish_id
+                    },
+                    "time": window,
+                    "fields": rollup_fields,
+                })
+            if opts.rollup_only:
+                return
         if gstate.start_timestamp is None:
             gstate.start_timestamp = timestamp
             gstate.start_counter = counter
@@ -264,8 +650,28 @@ def loop_body(opts, gstate):
             # save off counter value for script restart
             points[-1]["fields"]["counter"] = counter + count
 
+    def cb_add_outage(event, timestamp, duration, cause):
+        # end events are recorded at the time the outage ended
+        gstate.points.append({
+            "measurement": OUTAGE_MEASUREMENT,
+            "tags": {
+                "id": gstate.dish_id,
+                "event": event
+            },
+            "time": timestamp + duration if event == "end" else timestamp,
+            "fields": {
+                "duration": duration,
+                "cause": cause
+            },
+        })
+
     now = time.time()
-    rc = dish_common.get_data(opts, gstate, cb_add_item, cb_add_sequence, add_bulk=cb_add_bulk)
+    rc = get_data(opts,
+                  gstate,
+                  cb_add_item,
+                  cb_add_sequence,
+                  add_bulk=cb_add_bulk,
+                  add_outage=cb_add_outage)
     if rc:
         return rc
 
@@ -286,45 +692,132 @@ def loop_body(opts, gstate):
     if opts.bulk_mode and not gstate.timebase_synced:
         sync_timebase(opts, gstate)
 
-    if opts.verbose:
-        print("Data points queued: " + str(len(gstate.points)))
+    return queue_points(opts, gstate)
 
-    if len(gstate.points) >= FLUSH_LIMIT:
-        return flush_points(opts, gstate)
 
-    return 0
+def connect(opts, dest):
+    if 'token' in dest.icargs:
+        from influxdb_client import InfluxDBClient
+        from influxdb_client.client.write_api import SYNCHRONOUS
 
+        dest.influx_client = InfluxDBClient(**dest.icargs, enable_gzip=True)
+        # The client keeps its HTTP connections open for reuse, as long as
+        # the same write API object is used for every write.
+        dest.write_api = dest.influx_client.write_api(write_options=SYNCHRONOUS)
+        return
 
-def main():
-    opts = parse_args()
+    from influxdb import InfluxDBClient
+
+    # The headers are an attempt to hack around breakage between
+    # influxdb-python client and 2.0 server. Older influxdb-python package
+    # versions support neither that nor gzip, and some support only headers,
+    # so drop them one at a time until the client accepts what's left.
+    attempts = (
+        ("gzip compression and Accept header", {
+            "gzip": True,
+            "headers": {
+                "Accept": "application/json"
+            }
+        }),
+        ("Accept header", {
+            "headers": {
+                "Accept": "application/json"
+            }
+        }),
+    )
+    for description, kwargs in attempts:
+        try:
+            dest.influx_client = InfluxDBClient(**dest.icargs, **kwargs)
+            break
+        except TypeError:
+            # ...unless influxdb-python package version is too old for it
+            pass
+    else:
+        description = "no compression or Accept header"
+        dest.influx_client = InfluxDBClient(**dest.icargs)
+    if opts.verbose:
+        print(describe(dest, "Using InfluxDB client with " + description))
 
-    logging.basicConfig(format="%(levelname)s: %(message)s")
 
-    gstate = dish_common.GlobalState()
+def setup(opts, gstate):
+    """Set up the state needed for writing to the InfluxDB databases."""
+    # data points from the current loop iteration, before they are queued
+    # for each database
     gstate.points = []
     gstate.deferred_points = []
-    gstate.timebase_synced = opts.skip_query
+    # With --rollup-only, there are no raw bulk points to line up with those
+    # already in the database.
+    gstate.timebase_synced = opts.skip_query or opts.rollup_only
     gstate.start_timestamp = None
     gstate.start_counter = None
+    gstate.checkpoint = None
+    gstate.saved_checkpoint = None
+    gstate.rollup = dish_common.BulkRollup(opts.rollup) if opts.rollup else None
+
+    gstate.destinations = []
+    for dest_opts in [opts] + opts.replicas:
+        gstate.destinations.append(
+            Destination(database_name(dest_opts) if opts.replicas else None, dest_opts.icargs,
+                        dest_opts.retention_policy, dest_opts.batch_size))
+        if "verify_ssl" in dest_opts.icargs and not dest_opts.icargs["verify_ssl"]:
+            # user has explicitly said be insecure, so don't warn about it
+            warnings.filterwarnings("ignore", message="Unverified HTTPS request")
+
+    for dest in gstate.destinations:
+        connect(opts, dest)
+    # used for the prior sample write point query
+    gstate.influx_client = gstate.destinations[0].influx_client
+
+    if opts.replicas:
+        for dest in gstate.destinations:
+            dest.incoming = queue.Queue()
+            dest.writer = threading.Thread(target=run_writer, args=(opts, gstate, dest))
+            dest.writer.start()
+
+
+def shutdown(opts, gstate):
+    """Flush any remaining data points and close the database clients.
+
+    Returns:
+        1 if there was a failure writing the remaining data points, or some
+        could not be written because the prior sample write point was never
+        found, otherwise 0.
+    """
+    rc = 0
+    if gstate.deferred_points:
+        logging.error("Discarding %d bulk data points not written due to failed InfluxDB query",
+                      len(gstate.deferred_points))
+        rc = 1
+    try:
+        for dest in gstate.destinations:
+            if dest.writer is not None:
+                dest.incoming.put(None)
+        for dest in gstate.destinations:
+            if dest.writer is not None:
+                dest.writer.join()
+                rc = max(rc, dest.rc)
+            elif dest.points:
+                rc = max(rc, flush_points(opts, gstate, dest))
+    finally:
+        for dest in gstate.destinations:
+            if dest.write_api is not None:
+                dest.write_api.close()
+            if dest.influx_client is not None:
+                dest.influx_client.close()
+    return rc
 
-    if "verify_ssl" in opts.icargs and not opts.icargs["verify_ssl"]:
-        # user has explicitly said be insecure, so don't warn about it
-        warnings.filterwarnings("ignore", message="Unverified HTTPS request")
 
-    signal.signal(signal.SIGTERM, handle_sigterm)
-    if 'token' in opts.icargs:
-        from influxdb_client import InfluxDBClient
-        from influxdb_client.client.write_api import SYNCHRONOUS
-    else:
-        from influxdb import InfluxDBClient
+def main():
+    opts = parse_args()
 
-    try:
-        # attempt to hack around breakage between influxdb-python client and 2.0 server:
-        gstate.influx_client = InfluxDBClient(**opts.icargs, headers={"Accept": "application/json"})
-    except TypeError:
-        # ...unless influxdb-python package version is too old
-        gstate.influx_client = InfluxDBClient(**opts.icargs)
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    gstate = dish_common.GlobalState(opts)
+    setup(opts, gstate)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
 
+    rc = 0
     try:
         next_loop = time.monotonic()
         while True:
@@ -338,9 +831,7 @@ def main():
     except Terminated:
         pass
     finally:
-        if gstate.points:
-            rc = flush_points(opts, gstate)
-        gstate.influx_client.close()
+        rc = shutdown(opts, gstate) or rc
         gstate.shutdown()
 
     sys.exit(rc)
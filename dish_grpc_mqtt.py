@@ -6,6 +6,7 @@ history data and publishes them to the specified MQTT broker either once or
 in a periodic loop.
 """
 
+import json
 import logging
 import sys
 import time
@@ -23,9 +24,10 @@ import dish_common
 HOST_DEFAULT = "localhost"
 
 
-def parse_args():
+def parse_args(args=None):
     parser = dish_common.create_arg_parser(output_description="publish it to a MQTT broker",
-                                           bulk_history=False)
+                                           bulk_history=False,
+                                           outages=True)
 
     group = parser.add_argument_group(title="MQTT broker options")
     group.add_argument("-n",
@@ -61,7 +63,7 @@ def parse_args():
     else:
         parser.epilog += "\nSSL support options not available due to missing ssl module"
 
-    opts = dish_common.run_arg_parser(parser, need_id=True)
+    opts = dish_common.run_arg_parser(parser, need_id=True, args=args)
 
     if opts.username is None and opts.password is not None:
         parser.error("Password authentication requires username to be set")
@@ -80,7 +82,7 @@ def parse_args():
     return opts
 
 
-def loop_body(opts, gstate):
+def loop_body(opts, gstate, get_data=dish_common.get_data):
     msgs = []
 
     def cb_add_item(key, val, category):
@@ -92,7 +94,15 @@ def loop_body(opts, gstate):
             ("starlink/dish_{0}/{1}/{2}".format(category, gstate.dish_id,
                                                 key), ",".join(str(x) for x in val), 0, False))
 
-    rc = dish_common.get_data(opts, gstate, cb_add_item, cb_add_sequence)
+    def cb_add_outage(event, timestamp, duration, cause):
+        msgs.append(("starlink/dish_outage/{0}/{1}".format(gstate.dish_id, event),
+                     json.dumps({
+                         "start": timestamp,
+                         "duration": duration,
+                         "cause": cause
+                     }), 0, False))
+
+    rc = get_data(opts, gstate, cb_add_item, cb_add_sequence, add_outage=cb_add_outage)
 
     if msgs:
         try:
@@ -101,6 +111,9 @@ def loop_body(opts, gstate):
                 print("Successfully published to MQTT broker")
         except Exception as e:
             dish_common.conn_error(opts, "Failed publishing to MQTT broker: %s", str(e))
+            # with --changes-only, values that failed to publish must not be
+            # considered already sent
+            gstate.last_values.clear()
             rc = 1
 
     return rc
@@ -111,7 +124,7 @@ def main():
 
     logging.basicConfig(format="%(levelname)s: %(message)s")
 
-    gstate = dish_common.GlobalState()
+    gstate = dish_common.GlobalState(opts)
 
     try:
         next_loop = time.monotonic()
@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+"""Publish Starlink user terminal data to a shared memory snapshot file.
+
+This script pulls the current status info and/or metrics computed from the
+history data and writes the most recent values, along with a rolling window
+of bulk history data, to a memory-mapped file, either once or in a periodic
+loop. Any number of other programs on the same host can then read a
+consistent snapshot of that data using the starlink_snapshot module, without
+having to talk to the user terminal themselves.
+
+See the starlink_snapshot module docs for detail on the file format.
+"""
+
+import logging
+import signal
+import sys
+import time
+
+import dish_common
+import starlink_grpc
+import starlink_snapshot
+
+
+class Terminated(Exception):
+    pass
+
+
+def handle_sigterm(signum, frame):
+    # Turn SIGTERM into an exception so main loop can clean up
+    raise Terminated
+
+
+def parse_args(args=None):
+    parser = dish_common.create_arg_parser(
+        output_description="write it to a memory-mapped snapshot file")
+
+    group = parser.add_argument_group(title="Snapshot file options")
+    group.add_argument("-f",
+                       "--file",
+                       default=starlink_snapshot.default_filename(),
+                       help="Snapshot file to write, which will be replaced if it exists, default: "
+                       "%(default)s",
+                       metavar="FILENAME")
+    group.add_argument("-w",
+                       "--window",
+                       type=int,
+                       default=starlink_snapshot.WINDOW_DEFAULT,
+                       help="Number of bulk history samples to keep in the snapshot, default: " +
+                       str(starlink_snapshot.WINDOW_DEFAULT),
+                       metavar="SAMPLES")
+
+    opts = dish_common.run_arg_parser(parser, need_id=True, args=args)
+
+    if opts.window <= 0:
+        parser.error("Window must be a positive number of samples")
+    if opts.changes_only:
+        parser.error("Changes only output cannot be used for snapshot output")
+
+    return opts
+
+
+def loop_body(opts, gstate, get_data=dish_common.get_data):
+    status = {"status": {}, "ping_stats": {}}
+    bulk_data = {}
+
+    def cb_add_item(key, val, category):
+        status[category][key] = val
+
+    def cb_add_sequence(key, val, category, _):
+        status[category][key] = list(val)
+
+    def cb_add_bulk(bulk, count, timestamp, counter):
+        bulk_data.update(bulk=bulk, count=count, timestamp=timestamp, counter=counter)
+
+    rc = get_data(opts, gstate, cb_add_item, cb_add_sequence, add_bulk=cb_add_bulk)
+
+    # Modes that were not polled this time keep their prior values.
+    changed = False
+    for category, fields in status.items():
+        if fields:
+            gstate.status[category] = fields
+            changed = True
+    if gstate.dish_id is not None:
+        gstate.status["id"] = gstate.dish_id
+
+    try:
+        gstate.snapshot.update(gstate.status if changed else None, **bulk_data)
+    except starlink_snapshot.SnapshotError as e:
+        logging.error("Failed updating snapshot: %s", str(e))
+        rc = 1
+    else:
+        dish_common.save_bulk_state(opts, gstate)
+        if opts.verbose:
+            print("Updated snapshot file")
+
+    return rc
+
+
+def setup(opts, gstate):
+    """Create the snapshot file."""
+    columns = [
+        dish_common.BRACKETS_RE.match(name).group(1)
+        for name in starlink_grpc.history_bulk_field_names()[1]
+    ]
+    gstate.status = {"status": {}, "ping_stats": {}}
+    gstate.snapshot = starlink_snapshot.SnapshotWriter(opts.file, columns, window=opts.window)
+
+
+def shutdown(opts, gstate):
+    """Close the snapshot file, leaving it in place for readers.
+
+    Returns:
+        0, since all data has already been written.
+    """
+    gstate.snapshot.close()
+    return 0
+
+
+def main():
+    opts = parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    gstate = dish_common.GlobalState(opts)
+    try:
+        setup(opts, gstate)
+    except OSError as e:
+        logging.error("Failed creating snapshot file: %s", str(e))
+        gstate.shutdown()
+        sys.exit(1)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    rc = 0
+    try:
+        next_loop = time.monotonic()
+        while True:
+            rc = loop_body(opts, gstate)
+            if opts.loop_interval > 0.0:
+                now = time.monotonic()
+                next_loop = max(next_loop + opts.loop_interval, now)
+                time.sleep(next_loop - now)
+            else:
+                break
+    except Terminated:
+        pass
+    finally:
+        shutdown(opts, gstate)
+        gstate.shutdown()
+
+    sys.exit(rc)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+#!/usr/bin/python3
+"""Write Starlink user terminal data to a sqlite database.
+
+This script pulls the current status info and/or metrics computed from the
+history data and writes them to the specified sqlite database either once or
+in a periodic loop.
+
+Status data is written to the "status" table and history stats to the
+"ping_stats" table, one row per dish per loop iteration, keyed by dish ID and
+time. Bulk history samples are written to the "history" table, keyed by dish
+ID, counter epoch, and sample counter, where the counter epoch is the
+(approximate) time the dish started counting samples, so that samples from
+before and after a dish reboot do not collide. Writing samples that are
+already in the database is harmless, so overlapping ranges of samples, such
+as after this script is restarted, do not need special handling.
+
+Tables are created as needed, and columns are added to them as new fields
+show up in the data, so there is no fixed schema to get out of date when the
+dish firmware adds fields. Sequence fields are stored with one column per
+item, named the same way as for InfluxDB output.
+
+The database is opened in write-ahead log mode, and everything from one loop
+iteration is written in a single transaction, which keeps the write load low
+enough for flash storage, and lets other programs read the database while
+data is being written. Multiple instances of this script, one per dish, can
+safely write to the same database file.
+
+NOTE: The Starlink user terminal does not include time values with its
+history or status data, so this script uses current system time to compute
+the timestamps it writes to the database. It is recommended to run this
+script on a host that has its system clock synced via NTP. Otherwise, the
+timestamps may get out of sync with real time.
+"""
+
+import logging
+import signal
+import sqlite3
+import sys
+import time
+
+import dish_common
+
+DATABASE_DEFAULT = "starlink.sqlite"
+# How long to wait, in seconds, for another writer to finish with the
+# database before giving up on writing data
+BUSY_TIMEOUT = 30.0
+# Maximum difference, in seconds, between the computed start time of the
+# sample counter and that of samples already in the database for them to be
+# considered the same counter epoch. Anything much larger than the time base
+# drift allowed by get_data will do, as long as it is shorter than the time
+# it takes the dish to reboot.
+EPOCH_TOLERANCE = 60
+# How often, in seconds, to delete data older than the --max-age option
+PRUNE_INTERVAL = 3600
+# Columns at the start of each table. For the status and ping_stats tables,
+# these are the primary key. For the history table, all but time are.
+KEY_COLUMNS = {
+    "status": ("id", "time"),
+    "ping_stats": ("id", "time"),
+    "history": ("id", "counter_epoch", "counter", "time"),
+}
+
+
+class Terminated(Exception):
+    pass
+
+
+def handle_sigterm(signum, frame):
+    # Turn SIGTERM into an exception so main loop can clean up
+    raise Terminated
+
+
+def parse_args(args=None):
+    parser = dish_common.create_arg_parser(output_description="write it to a sqlite database")
+
+    group = parser.add_argument_group(title="sqlite database options")
+    group.add_argument("-D",
+                       "--database",
+                       default=DATABASE_DEFAULT,
+                       help="Database file to use, which will be created if it does not exist, "
+                       "default: " + DATABASE_DEFAULT,
+                       metavar="FILENAME")
+    group.add_argument("--max-age",
+                       type=float,
+                       help="Delete data for this dish that is older than this many days, checked "
+                       "once per hour when running in a loop",
+                       metavar="DAYS")
+
+    opts = dish_common.run_arg_parser(parser, need_id=True, args=args)
+
+    if opts.max_age is not None and opts.max_age <= 0.0:
+        parser.error("Max age must be a positive number of days")
+
+    return opts
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def sql_type(val):
+    # bool is a subclass of int, and sqlite has no separate boolean type
+    if isinstance(val, int):
+        return " INTEGER"
+    if isinstance(val, float):
+        return " REAL"
+    if isinstance(val, str):
+        return " TEXT"
+    # no type affinity, so values are stored however they come
+    return ""
+
+
+def create_tables(conn):
+    for table, key_columns in KEY_COLUMNS.items():
+        columns = ", ".join(
+            quote(column) + (" TEXT" if column == "id" else " INTEGER") + " NOT NULL"
+            for column in key_columns)
+        primary_key = ", ".join(quote(column) for column in key_columns if column != "time"
+                                or table != "history")
+        # Without a separate rowid, rows are stored in primary key order in a
+        # single b-tree, instead of in a table plus an index on the key.
+        conn.execute("CREATE TABLE IF NOT EXISTS {0} ({1}, PRIMARY KEY ({2})) WITHOUT ROWID".format(
+            quote(table), columns, primary_key))
+
+
+def table_columns(conn, table):
+    return set(row[1] for row in conn.execute("PRAGMA table_info({0})".format(quote(table))))
+
+
+def ensure_columns(gstate, table, values):
+    """Add columns to a table for any of the fields not already in it.
+
+    Args:
+        gstate (GlobalState): The state object, with the database connection.
+        table (str): Name of the table.
+        values (dict): A sample value for each field, which determines the
+            type of any new column.
+    """
+    columns = gstate.columns[table]
+    for name, val in values.items():
+        if name in columns:
+            continue
+        try:
+            gstate.sql_conn.execute("ALTER TABLE {0} ADD COLUMN {1}{2}".format(
+                quote(table), quote(name), sql_type(val)))
+        except sqlite3.OperationalError as e:
+            # another writer may have just added it
+            if name not in table_columns(gstate.sql_conn, table):
+                raise e
+        columns.add(name)
+
+
+def counter_epoch(opts, gstate, timestamp, counter):
+    # The sample counter starts over when the dish reboots, but the time
+    # at which it started stays the same until then, give or take time base
+    # drift. A big jump means the counter has started over.
+    estimate = timestamp - counter
+    if gstate.epoch_estimate is None or abs(estimate - gstate.epoch_estimate) > EPOCH_TOLERANCE:
+        # Use the epoch of samples already written for this dish, if any
+        # are close enough, so that rewriting them is recognized as such.
+        row = gstate.sql_conn.execute(
+            'SELECT "counter_epoch" FROM "history" WHERE "id"=? AND '
+            '"counter_epoch" BETWEEN ? AND ? ORDER BY "counter_epoch" DESC LIMIT 1',
+            (gstate.dish_id, estimate - EPOCH_TOLERANCE, estimate + EPOCH_TOLERANCE)).fetchone()
+        gstate.counter_epoch = row[0] if row else estimate
+        if opts.verbose:
+            print("Using counter epoch: " + str(gstate.counter_epoch))
+    gstate.epoch_estimate = estimate
+    return gstate.counter_epoch
+
+
+def write_row(gstate, table, timestamp, fields):
+    ensure_columns(gstate, table, fields)
+    columns = ["id", "time"] + list(fields)
+    gstate.sql_conn.execute(
+        "INSERT OR REPLACE INTO {0} ({1}) VALUES ({2})".format(quote(table),
+                                                               ", ".join(quote(x) for x in columns),
+                                                               ", ".join("?" * len(columns))),
+        [gstate.dish_id, timestamp] + list(fields.values()))
+    return 1
+
+
+def write_history(opts, gstate, bulk, count, timestamp, counter):
+    # first non-null value of each field determines the column type
+    ensure_columns(gstate, "history",
+                   {key: next((x for x in val if x is not None), None)
+                    for key, val in bulk.items()})
+    epoch = counter_epoch(opts, gstate, timestamp, counter)
+    columns = list(KEY_COLUMNS["history"]) + list(bulk)
+    rows = [(gstate.dish_id, epoch, counter + i, timestamp + i) + values
+            for i, values in enumerate(zip(*bulk.values()), start=1)]
+    # Samples that are already there are left alone, which avoids rewriting
+    # database pages just to put back the same data.
+    cur = gstate.sql_conn.executemany(
+        "INSERT OR IGNORE INTO {0} ({1}) VALUES ({2})".format(quote("history"),
+                                                              ", ".join(quote(x) for x in columns),
+                                                              ", ".join("?" * len(columns))),
+        rows)
+    return cur.rowcount
+
+
+def prune(opts, gstate):
+    cutoff = int(time.time() - opts.max_age * 86400)
+    deleted = 0
+    for table in ("status", "ping_stats"):
+        deleted += gstate.sql_conn.execute(
+            "DELETE FROM {0} WHERE \"id\"=? AND \"time\"<?".format(quote(table)),
+            (gstate.dish_id, cutoff)).rowcount
+    # History rows are keyed by counter, not time, so delete by counter
+    # range within each epoch, which can use the primary key. Sample time is
+    # approximately epoch + counter.
+    epoch = gstate.sql_conn.execute('SELECT MIN("counter_epoch") FROM "history" WHERE "id"=?',
+                                    (gstate.dish_id,)).fetchone()[0]
+    while epoch is not None and epoch < cutoff:
+        deleted += gstate.sql_conn.execute(
+            'DELETE FROM "history" WHERE "id"=? AND "counter_epoch"=? AND "counter"<?',
+            (gstate.dish_id, epoch, cutoff - epoch)).rowcount
+        epoch = gstate.sql_conn.execute(
+            'SELECT MIN("counter_epoch") FROM "history" WHERE "id"=? AND "counter_epoch">?',
+            (gstate.dish_id, epoch)).fetchone()[0]
+    return deleted
+
+
+def loop_body(opts, gstate, get_data=dish_common.get_data):
+    tables = {"status": {}, "ping_stats": {}}
+    bulk_data = []
+
+    def cb_add_item(key, val, category):
+        tables[category][key] = val
+
+    def cb_add_sequence(key, val, category, start):
+        for i, subval in enumerate(val, start=start):
+            tables[category]["{0}_{1}".format(key, i)] = subval
+
+    def cb_add_bulk(bulk, count, timestamp, counter):
+        if count:
+            bulk_data.append((bulk, count, timestamp, counter))
+
+    now = int(time.time())
+    rc = get_data(opts, gstate, cb_add_item, cb_add_sequence, add_bulk=cb_add_bulk)
+
+    prune_due = opts.max_age is not None and time.monotonic() >= gstate.next_prune
+    if not (any(tables.values()) or bulk_data or prune_due):
+        return rc
+
+    rows_written = 0
+    rows_deleted = 0
+    try:
+        # Take the write lock up front, since the counter epoch lookup would
+        # otherwise start a read transaction that may not be able to upgrade.
+        gstate.sql_conn.execute("BEGIN IMMEDIATE")
+        try:
+            for table, fields in tables.items():
+                if fields:
+                    rows_written += write_row(gstate, table, now, fields)
+            for bulk, count, timestamp, counter in bulk_data:
+                rows_written += write_history(opts, gstate, bulk, count, timestamp, counter)
+            if prune_due:
+                rows_deleted = prune(opts, gstate)
+            gstate.sql_conn.execute("COMMIT")
+        except BaseException:
+            # some errors roll back the transaction on their own
+            if gstate.sql_conn.in_transaction:
+                gstate.sql_conn.execute("ROLLBACK")
+            raise
+    except sqlite3.Error as e:
+        # these are not necessarily fatal, but also not much can do about it
+        logging.error("Failed writing to sqlite database, discarding data: %s", str(e))
+        # table columns may have been rolled back along with the data
+        for table in gstate.columns:
+            gstate.columns[table] = table_columns(gstate.sql_conn, table)
+        return 1
+
+    dish_common.save_bulk_state(opts, gstate)
+    if prune_due:
+        gstate.next_prune = time.monotonic() + PRUNE_INTERVAL
+    if opts.verbose:
+        print("Rows written to database: " + str(rows_written))
+        if prune_due:
+            print("Rows deleted from database: " + str(rows_deleted))
+
+    return rc
+
+
+def setup(opts, gstate):
+    """Open the sqlite database, creating the tables if needed."""
+    # Transactions are managed explicitly, one per loop iteration.
+    gstate.sql_conn = sqlite3.connect(opts.database, timeout=BUSY_TIMEOUT, isolation_level=None)
+    gstate.sql_conn.execute("PRAGMA journal_mode=WAL")
+    # In WAL mode, this only syncs to storage at checkpoints, instead of on
+    # every commit, and still can't corrupt the database on power loss.
+    gstate.sql_conn.execute("PRAGMA synchronous=NORMAL")
+    create_tables(gstate.sql_conn)
+    gstate.columns = {table: table_columns(gstate.sql_conn, table) for table in KEY_COLUMNS}
+    gstate.counter_epoch = None
+    gstate.epoch_estimate = None
+    gstate.next_prune = time.monotonic()
+
+
+def shutdown(opts, gstate):
+    """Close the sqlite database.
+
+    Returns:
+        0, since all data has already been written.
+    """
+    gstate.sql_conn.close()
+    return 0
+
+
+def main():
+    opts = parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    gstate = dish_common.GlobalState(opts)
+    try:
+        setup(opts, gstate)
+    except sqlite3.Error as e:
+        logging.error("Failed opening sqlite database: %s", str(e))
+        gstate.shutdown()
+        sys.exit(1)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    rc = 0
+    try:
+        next_loop = time.monotonic()
+        while True:
+            rc = loop_body(opts, gstate)
+            if opts.loop_interval > 0.0:
+                now = time.monotonic()
+                next_loop = max(next_loop + opts.loop_interval, now)
+                time.sleep(next_loop - now)
+            else:
+                break
+    except Terminated:
+        pass
+    finally:
+        shutdown(opts, gstate)
+        gstate.shutdown()
+
+    sys.exit(rc)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+"""Stream Starlink user terminal data to web clients as server-sent events.
+
+This script runs a small HTTP server that polls the user terminal once per
+loop interval and pushes what changed to any number of subscribed clients,
+such as browser based dashboards, using the server-sent events protocol (the
+EventSource interface, in browsers). This way, the user terminal only gets
+polled once, no matter how many clients there are.
+
+Clients subscribe by requesting /events from the server, and then receive the
+following events, each with data in JSON format:
+
+: **status** : The status data and/or history stats fields that have changed,
+    under "status" and "ping_stats", respectively, along with the dish ID
+    under "id" and the poll time under "time". The first one sent to each
+    client has all the fields, not just the ones that changed.
+: **history** : New bulk history samples, with the time and counter value of
+    the most recent one under "end_timestamp" and "end_counter", the number of
+    samples under "samples", and a list of values for each of the bulk history
+    fields.
+: **outage** : An outage start or end event, with the event type under
+    "event", and "start", "duration", and "cause" as described for
+    OutageTracker in dish_common.
+
+Each client gets a limited size queue of events waiting to be sent to it. A
+client that falls too far behind, because it is reading too slowly, is
+disconnected, so that it does not hold up or use up memory for the others.
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import signal
+import sys
+import time
+
+import dish_common
+
+BIND_DEFAULT = "localhost"
+PORT_DEFAULT = 8080
+QUEUE_SIZE_DEFAULT = 100
+# How long, in seconds, to wait for a client to send its request
+REQUEST_TIMEOUT = 10.0
+# How often, in seconds, to send a comment to idle clients, so that proxies
+# and the like don't close the connection
+KEEPALIVE_INTERVAL = 15.0
+EVENT_PATHS = ("/", "/events")
+
+
+def parse_args(args=None):
+    parser = dish_common.create_arg_parser(
+        output_description="stream it to web clients as server-sent events", outages=True)
+
+    group = parser.add_argument_group(title="HTTP server options")
+    group.add_argument("-b",
+                       "--bind",
+                       default=BIND_DEFAULT,
+                       help="Address on which to listen for clients, or an empty string for all "
+                       "addresses, default: " + BIND_DEFAULT,
+                       metavar="ADDRESS")
+    group.add_argument("-p",
+                       "--port",
+                       type=int,
+                       default=PORT_DEFAULT,
+                       help="Port on which to listen for clients, default: " + str(PORT_DEFAULT))
+    group.add_argument("--queue-size",
+                       type=int,
+                       default=QUEUE_SIZE_DEFAULT,
+                       help="Number of events that can be waiting to be sent to a client before "
+                       "it gets disconnected, default: " + str(QUEUE_SIZE_DEFAULT),
+                       metavar="N")
+
+    opts = dish_common.run_arg_parser(parser, need_id=True, args=args)
+
+    if opts.loop_interval <= 0.0:
+        parser.error("Loop interval must be set for streaming")
+    if opts.changes_only:
+        parser.error("Changes only output cannot be used for streaming, since changes are always "
+                     "streamed")
+    if opts.state_file:
+        parser.error("State file cannot be used for streaming, since nothing is saved")
+    if opts.queue_size < 1:
+        parser.error("Queue size must be at least 1")
+
+    return opts
+
+
+class Client:
+    """An event stream client, along with its queue of events to send."""
+    def __init__(self, writer, queue_size):
+        self.writer = writer
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.task = asyncio.current_task()
+        self.name = "{0}:{1}".format(*writer.get_extra_info("peername")[:2])
+
+
+def format_event(event, data):
+    # Each event is encoded only once, no matter how many clients it goes to.
+    return "event: {0}\ndata: {1}\n\n".format(event, json.dumps(data,
+                                                                separators=(",", ":"))).encode()
+
+
+def close_client(gstate, client):
+    gstate.clients.discard(client)
+    # Discard whatever is still waiting to be sent, which also wakes up the
+    # client's task if it is waiting for that to be sent, and if not, wake it
+    # up with an end marker.
+    client.writer.transport.abort()
+    try:
+        client.queue.put_nowait(None)
+    except asyncio.QueueFull:
+        pass
+
+
+def drop_client(opts, gstate, client):
+    close_client(gstate, client)
+    if opts.verbose:
+        print("Dropped slow client: " + client.name)
+
+
+def broadcast(opts, gstate, message):
+    for client in list(gstate.clients):
+        try:
+            client.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            drop_client(opts, gstate, client)
+
+
+def full_status(gstate):
+    data = {"id": gstate.dish_id, "time": gstate.status_time}
+    data.update(gstate.state)
+    return data
+
+
+def http_response(status, headers=()):
+    lines = ["HTTP/1.1 " + status]
+    lines.extend(headers)
+    return ("\r\n".join(lines) + "\r\n\r\n").encode()
+
+
+async def handle_client(opts, gstate, reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT)
+        method, path = request.decode("latin-1").split(" ", 2)[:2]
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+            ConnectionError, ValueError):
+        writer.close()
+        return
+
+    if method != "GET":
+        writer.write(http_response("405 Method Not Allowed", ["Allow: GET", "Connection: close"]))
+    elif path.split("?", 1)[0] not in EVENT_PATHS:
+        writer.write(http_response("404 Not Found", ["Connection: close"]))
+    else:
+        await stream_events(opts, gstate, writer)
+        return
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
+
+
+async def stream_events(opts, gstate, writer):
+    client = Client(writer, opts.queue_size)
+    writer.write(
+        http_response("200 OK", [
+            "Content-Type: text/event-stream",
+            "Cache-Control: no-cache",
+            "Connection: keep-alive",
+            "Access-Control-Allow-Origin: *",
+        ]))
+    if gstate.status_time is not None:
+        client.queue.put_nowait(format_event("status", full_status(gstate)))
+    gstate.clients.add(client)
+    if opts.verbose:
+        print("Client connected: " + client.name)
+
+    try:
+        while True:
+            try:
+                message = await asyncio.wait_for(client.queue.get(), KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                message = b": keepalive\n\n"
+            if message is None:
+                break
+            writer.write(message)
+            await writer.drain()
+    except ConnectionError:
+        if opts.verbose and client in gstate.clients:
+            print("Client disconnected: " + client.name)
+    finally:
+        gstate.clients.discard(client)
+        writer.close()
+
+
+def poll(opts, gstate):
+    """Poll the dish, collecting the data into lists of call back args.
+
+    This runs on the executor thread, so must not touch the client state.
+    """
+    items = []
+    bulk_data = []
+    outages = []
+
+    def cb_add_item(key, val, category):
+        items.append((key, val, category))
+
+    def cb_add_sequence(key, val, category, _):
+        items.append((key, list(val), category))
+
+    def cb_add_bulk(bulk, count, timestamp, counter):
+        bulk_data.append((bulk, count, timestamp, counter))
+
+    def cb_add_outage(event, timestamp, duration, cause):
+        outages.append((event, timestamp, duration, cause))
+
+    now = int(time.time())
+    dish_common.get_data(opts,
+                         gstate,
+                         cb_add_item,
+                         cb_add_sequence,
+                         add_bulk=cb_add_bulk,
+                         add_outage=cb_add_outage)
+    return now, items, bulk_data, outages
+
+
+def publish(opts, gstate, now, items, bulk_data, outages):
+    changes = {}
+    for key, val, category in items:
+        fields = gstate.state[category]
+        if key not in fields or fields[key] != val:
+            fields[key] = val
+            changes.setdefault(category, {})[key] = val
+    if items:
+        gstate.status_time = now
+    if changes:
+        changes["id"] = gstate.dish_id
+        changes["time"] = now
+        broadcast(opts, gstate, format_event("status", changes))
+
+    for bulk, count, timestamp, counter in bulk_data:
+        if count:
+            data = {
+                "end_timestamp": timestamp + count,
+                "end_counter": counter + count,
+                "samples": count
+            }
+            data.update(bulk)
+            broadcast(opts, gstate, format_event("history", data))
+
+    for event, timestamp, duration, cause in outages:
+        broadcast(
+            opts, gstate,
+            format_event("outage", {
+                "event": event,
+                "start": timestamp,
+                "duration": duration,
+                "cause": cause
+            }))
+
+
+async def poll_loop(opts, gstate):
+    loop = asyncio.get_running_loop()
+    # get_data is not safe to run concurrently with itself, and it blocks,
+    # so it gets a thread to itself.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        next_loop = time.monotonic()
+        while True:
+            try:
+                publish(opts, gstate, *await loop.run_in_executor(executor, poll, opts, gstate))
+            except Exception as e:
+                # Keep serving clients, and try again next time
+                logging.error("Unexpected error polling dish: %s", str(e))
+            now = time.monotonic()
+            next_loop = max(next_loop + opts.loop_interval, now)
+            await asyncio.sleep(next_loop - now)
+
+
+async def serve(opts, gstate):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except (NotImplementedError, AttributeError):
+            # not supported on this platform, so just get killed instead
+            pass
+
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_client(opts, gstate, reader, writer), opts.bind or None,
+        opts.port)
+    if opts.verbose:
+        print("Listening on: " +
+              ", ".join("{0}:{1}".format(*sock.getsockname()[:2]) for sock in server.sockets))
+    poller = asyncio.ensure_future(poll_loop(opts, gstate))
+    stopper = asyncio.ensure_future(stop.wait())
+    try:
+        # the poll loop only finishes if something goes very wrong
+        await asyncio.wait([poller, stopper], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        server.close()
+        tasks = [client.task for client in gstate.clients]
+        for client in list(gstate.clients):
+            close_client(gstate, client)
+        for task in (poller, stopper):
+            task.cancel()
+        await asyncio.gather(poller, stopper, *tasks, return_exceptions=True)
+        await server.wait_closed()
+
+
+def main():
+    opts = parse_args()
+
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    gstate = dish_common.GlobalState(opts)
+    gstate.clients = set()
+    gstate.state = {"status": {}, "ping_stats": {}}
+    gstate.status_time = None
+
+    rc = 0
+    try:
+        asyncio.run(serve(opts, gstate))
+    except OSError as e:
+        logging.error("Failed starting server: %s", str(e))
+        rc = 1
+    finally:
+        gstate.shutdown()
+
+    sys.exit(rc)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,13 +2,25 @@
 """Output Starlink user terminal data info in text format.
 
 This script pulls the current status info and/or metrics computed from the
-history data and prints them to stdout either once or in a periodic loop.
-By default, it will print the results in CSV format.
+history data and prints them to stdout, or to a file, either once or in a
+periodic loop. By default, it will print the results in CSV format, but it
+can also output NDJSON, Arrow IPC stream, or Parquet format, the latter 2 of
+which require the pyarrow module.
+
+When writing to a file, the output can be split into multiple files by time
+and/or size, and completed files can be compressed using gzip or zstd, the
+latter of which requires the zstandard module.
 """
 
+import csv
 from datetime import datetime
+import json
 import logging
+import os
+import queue
+import shutil
 import sys
+import threading
 import time
 
 import dish_common
@@ -36,29 +48,124 @@ VERBOSE_FIELD_MAP = {
     "final_run_fragment": "Final drop run fragment",
     "run_seconds": "Per-second drop runs",
     "run_minutes": "Per-minute drop runs",
+
+    # ping_latency fields
+    "mean_ping_latency": "Mean latency",
+    "p50_ping_latency": "Median latency",
+    "p90_ping_latency": "90th pctile latency",
+    "p99_ping_latency": "99th pctile latency",
+    "max_ping_latency": "Max latency",
+    "ping_latency_histogram": "Latency histogram",
+}
+
+# Two digit seconds values, for building bulk mode timestamps.
+SECONDS = ["{0:02}".format(x) for x in range(60)]
+
+FORMATS = ["csv", "ndjson", "arrow", "parquet"]
+COLUMNAR_FORMATS = ["arrow", "parquet"]
+COMPRESS_METHODS = {"gzip": ".gz", "zstd": ".zst"}
+# Arrow type names of the bulk history fields, for when the type can't be
+# inferred from the data, such as latency during a total ping drop outage.
+BULK_FIELD_TYPES = {
+    "pop_ping_drop_rate": "double",
+    "pop_ping_latency_ms": "double",
+    "downlink_throughput_bps": "double",
+    "uplink_throughput_bps": "double",
+    "snr": "double",
+    "scheduled": "bool",
+    "obstructed": "bool",
 }
+# Maximum number of loop iterations' worth of records to hold back while
+# waiting for data from which to infer the Arrow schema.
+ARROW_PENDING_LIMIT = 10
 
 
-def parse_args():
+def parse_args(args=None):
     parser = dish_common.create_arg_parser(
         output_description=
         "print it to standard output in text format; by default, will print in CSV format")
 
-    group = parser.add_argument_group(title="CSV output options")
+    group = parser.add_argument_group(title="Output options")
+    group.add_argument("-f",
+                       "--format",
+                       choices=FORMATS,
+                       default="csv",
+                       help="Output format, one of: " + ", ".join(FORMATS) + "; arrow and parquet "
+                       "formats replace the output file instead of appending to it, default: csv")
+    group.add_argument("--rotate-interval",
+                       type=float,
+                       help="Start a new output file this often, with the start time added to the "
+                       "file name; parquet files cannot be read until they are finished",
+                       metavar="SECONDS")
+    group.add_argument("--rotate-size",
+                       type=float,
+                       help="Start a new output file once the current one reaches this size; "
+                       "not supported for arrow or parquet format",
+                       metavar="MEGABYTES")
+    group.add_argument("--compress",
+                       choices=list(COMPRESS_METHODS),
+                       help="Compress each output file once a new one has been started, using "
+                       "one of: " + ", ".join(COMPRESS_METHODS) + "; not supported for arrow or "
+                       "parquet format")
     group.add_argument("-H",
                        "--print-header",
                        action="store_true",
                        help="Print CSV header instead of parsing data")
+    group.add_argument("-O",
+                       "--out-file",
+                       help="Write output to this file instead of to standard output, appending "
+                       "to it if it already exists",
+                       metavar="FILENAME")
+
+    opts = dish_common.run_arg_parser(parser, no_stdout_errors=True, args=args)
 
-    opts = dish_common.run_arg_parser(parser, no_stdout_errors=True)
+    if opts.format != "csv":
+        if opts.verbose:
+            parser.error("Output format cannot be set for verbose output")
+        if opts.print_header:
+            parser.error("Header can only be printed for CSV output")
+    if opts.format in COLUMNAR_FORMATS:
+        try:
+            import pyarrow
+        except ImportError:
+            parser.error("The pyarrow module is required for {0} output".format(opts.format))
+        if opts.format == "parquet" and not opts.out_file:
+            parser.error("Parquet output requires an output file to be set")
+    opts.rotate = opts.rotate_interval is not None or opts.rotate_size is not None
+    if opts.rotate:
+        if not opts.out_file:
+            parser.error("Rotating output requires an output file to be set")
+        if opts.rotate_interval is not None and opts.rotate_interval <= 0.0:
+            parser.error("Rotate interval must be a positive number of seconds")
+        if opts.rotate_size is not None and (opts.rotate_size <= 0.0
+                                             or opts.format in COLUMNAR_FORMATS):
+            parser.error("Rotate size must be positive and is not supported for {0} "
+                         "output".format(opts.format))
+        if opts.print_header:
+            parser.error("Header is written to each output file automatically when rotating")
+    if opts.compress:
+        if not opts.rotate or opts.format in COLUMNAR_FORMATS:
+            parser.error("Compression requires rotating output and is not supported for {0} "
+                         "output".format(opts.format))
+        if opts.compress == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                parser.error("The zstandard module is required for zstd compression")
 
     if len(opts.mode) > 1 and "bulk_history" in opts.mode:
-        parser.error("bulk_history cannot be combined with other modes for CSV output")
+        parser.error("bulk_history cannot be combined with other modes for text output")
+    if opts.format == "csv" and not opts.verbose:
+        if len(set(opts.mode_intervals.values())) > 1:
+            parser.error("Modes cannot use different loop intervals for CSV output")
+        if opts.changes_only:
+            parser.error("Changes only output cannot be used for CSV output")
 
     return opts
 
 
-def print_header(opts):
+def header_fields(opts):
+    """Return the list of CSV column names for the selected modes."""
     header = ["datetimestamp_utc"]
 
     def header_add(names):
@@ -92,11 +199,395 @@ def print_header(opts):
             header_add(ping)
         if "ping_run_length" in opts.mode:
             header_add(runlen)
+        if "ping_latency" in opts.mode:
+            header_add(starlink_grpc.history_latency_field_names()[1])
+
+    return header
+
+
+def print_header(opts, file=None):
+    print(",".join(header_fields(opts)), file=file)
+
+
+def bulk_timestamps(timestamp, count, utc=False):
+    """Return the ISO format time strings for a range of bulk mode samples.
+
+    Converting each sample's timestamp separately is slow, so this only does
+    it at the start of each minute and fills in the seconds from there.
+
+    Args:
+        timestamp (int): Time of the sample prior to the first one.
+        count (int): Number of samples.
+        utc (bool): Optionally use UTC instead of local time.
+    """
+    convert = datetime.utcfromtimestamp if utc else datetime.fromtimestamp
+    times = []
+    prefix = None
+    for ts in range(timestamp + 1, timestamp + count + 1):
+        second = ts % 60
+        if prefix is None or not second:
+            # strip off the seconds
+            prefix = convert(ts).isoformat()[:-2]
+        times.append(prefix + SECONDS[second])
+    return times
+
+
+def segment_start(now, interval):
+    """Return the start time of the rotation interval containing time now."""
+    return now - now % interval if interval is not None else int(now)
+
+
+def segment_filename(filename, start, index=0):
+    """Return the file name to use for an output file started at time start.
+
+    Args:
+        filename (str): The output file name, to which the start time will be
+            added.
+        start (float): The start time of the file.
+        index (int): Optionally, a number to add to the file name to
+            distinguish it from other files with the same start time.
+    """
+    base, ext = os.path.splitext(filename)
+    suffix = "-" + str(index) if index else ""
+    return "{0}-{1}{2}{3}".format(base,
+                                  datetime.utcfromtimestamp(start).strftime("%Y%m%dT%H%M%SZ"),
+                                  suffix, ext)
+
+
+def compress_file(filename, method):
+    """Compress a file, replacing it with the compressed version."""
+    if method == "zstd":
+        import zstandard
+        opener = zstandard.open
+    else:
+        import gzip
+        opener = gzip.open
+    out_filename = filename + COMPRESS_METHODS[method]
+    with open(filename, "rb") as infile:
+        with opener(out_filename + ".tmp", "wb") as outfile:
+            shutil.copyfileobj(infile, outfile)
+    os.replace(out_filename + ".tmp", out_filename)
+    os.remove(filename)
+
+
+class RotatingFile:
+    """A text output file that is split up into multiple files.
+
+    A new file is started when the current one has been open for too long or
+    has grown too large, but only when rotate_if_due is called, so that it
+    can be done between records. Completed files are compressed on a
+    background thread, so that writing the output never has to wait for it.
+
+    Args:
+        filename (str): The output file name, to which the start time of
+            each file will be added. When interval is set, that is the start
+            of the interval, so a file left part way through an interval by a
+            prior run is appended to, unless it was compressed or has
+            already reached size. Files are never reopened once finished, so
+            a number is added to the name of any later file started in the
+            same interval, or the same second if interval is not set.
+        interval (float): Optionally, the time, in seconds, after which to
+            start a new file. Files are started on multiples of this.
+        size (float): Optionally, the size, in bytes, after which to start a
+            new file.
+        compress (str): Optionally, the compression method to use on
+            completed files, one of the keys of COMPRESS_METHODS.
+        header (str): Optionally, a line of text to write at the start of
+            each new file.
+    """
+    def __init__(self, filename, interval=None, size=None, compress=None, header=None):
+        self.base_filename = filename
+        self.interval = interval
+        self.size = size
+        self.compress = compress
+        self.header = header
+        self.file = None
+        self.filename = None
+        self.used_filenames = set()
+        self.rotate_at = None
+        self.queue = None
+        self.compressor = None
+        if compress is not None:
+            self.queue = queue.Queue()
+            self.compressor = threading.Thread(target=self._compress_files)
+            self.compressor.start()
+
+    def _compress_files(self):
+        while True:
+            filename = self.queue.get()
+            if filename is None:
+                break
+            try:
+                compress_file(filename, self.compress)
+            except Exception as e:
+                logging.error("Failed compressing output file %s: %s", filename, str(e))
+
+    def _finished(self, filename):
+        # Never reopen a file this has already written, since it may have
+        # been handed off for compression, which removes it once done. A file
+        # left by a prior run can be continued, unless it was compressed or
+        # is already full.
+        if filename in self.used_filenames:
+            return True
+        if self.compress is not None and os.path.exists(filename +
+                                                        COMPRESS_METHODS[self.compress]):
+            return True
+        try:
+            return self.size is not None and os.path.getsize(filename) >= self.size
+        except OSError:
+            return False
+
+    def _open(self):
+        start = segment_start(time.time(), self.interval)
+        index = 0
+        self.filename = segment_filename(self.base_filename, start)
+        while self._finished(self.filename):
+            index += 1
+            self.filename = segment_filename(self.base_filename, start, index)
+        self.used_filenames.add(self.filename)
+        self.file = open(self.filename, "a")
+        if self.interval is not None:
+            self.rotate_at = start + self.interval
+        if self.header is not None and not self.file.tell():
+            self.file.write(self.header + "\n")
+
+    def _finish(self):
+        self.file.close()
+        self.file = None
+        if self.queue is not None:
+            self.queue.put(self.filename)
+
+    def rotate_if_due(self):
+        if self.file is None:
+            return
+        if (self.rotate_at is not None and time.time() >= self.rotate_at
+                or self.size is not None and self.file.tell() >= self.size):
+            self._finish()
+
+    def write(self, data):
+        if self.file is None:
+            self._open()
+        return self.file.write(data)
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        """Close the current file and wait for compression to finish."""
+        try:
+            if self.file is not None:
+                self._finish()
+        finally:
+            if self.compressor is not None:
+                self.queue.put(None)
+                self.compressor.join()
+
+
+class NdjsonWriter:
+    """Write records as newline delimited JSON objects.
+
+    Values are written using their JSON native types, so None is written as
+    null, and booleans as true and false.
+    """
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, timestamp, count, columns):
+        """Write records.
+
+        Args:
+            timestamp (int): Time of the first record.
+            count (int): Number of records.
+            columns (dict): Mapping of field name to sequence of count values.
+        """
+        names = ["datetimestamp_utc"]
+        names.extend(columns)
+        self.out.write("".join(
+            json.dumps(dict(zip(names, row))) + "\n"
+            for row in zip(bulk_timestamps(timestamp - 1, count, utc=True), *columns.values())))
+
+    def flush(self):
+        self.out.flush()
+
+    def close(self):
+        pass
+
+
+class ArrowWriter:
+    """Write records in Arrow IPC stream or Parquet file format.
+
+    The type of each field is taken from the first records written that have
+    a value for it, or from types, if set for that field. Records are held
+    back until every field has a type, but only up to ARROW_PENDING_LIMIT
+    calls to write, after which any fields still without one are written as
+    strings, since any other type can be converted to that.
+
+    Args:
+        opts (object): The options object returned from parse_args.
+        names (list): Optionally, the full list of field names, for records
+            that may be missing some of them.
+        types (dict): Optionally, a mapping of field name to Arrow type name,
+            to use for fields with no values from which to infer it.
+    """
+    def __init__(self, opts, names=None, types=None):
+        self.format = opts.format
+        self.out_file = opts.out_file
+        self.rotate_interval = opts.rotate_interval
+        self.names = names
+        self.types = types or {}
+        self.schema = None
+        self.pending = []
+        self.sink = None
+        self.writer = None
+        self.rotate_at = None
+
+    def write(self, timestamp, count, columns):
+        """Write records.
+
+        Args:
+            timestamp (int): Time of the first record.
+            count (int): Number of records.
+            columns (dict): Mapping of field name to sequence of values, of
+                which only the last count are used.
+        """
+        import pyarrow
+
+        # Bulk history data with no new samples can still have full length
+        # columns, and pyarrow requires all columns to be the same length.
+        if not count:
+            return
+        data = {
+            "datetimestamp_utc":
+                pyarrow.array(range(timestamp, timestamp + count),
+                              pyarrow.int64()).cast(pyarrow.timestamp("s", tz="UTC"))
+        }
+        if self.names is None:
+            for name, column in columns.items():
+                data[name] = column[-count:]
+        else:
+            for name in self.names:
+                data[name] = columns[name][-count:] if name in columns else [None] * count
+        table = pyarrow.table(data)
+
+        self.pending.append(table)
+        if self.schema is None:
+            self.schema = self._infer_schema(len(self.pending) >= ARROW_PENDING_LIMIT)
+            if self.schema is None:
+                return
+        self._write_pending()
+
+    def _infer_schema(self, force):
+        import pyarrow
+
+        fields = []
+        for field in self.pending[0].schema:
+            field_type = None
+            for table in self.pending:
+                table_type = table.schema.field(field.name).type
+                if not pyarrow.types.is_null(table_type):
+                    field_type = table_type
+                    break
+            if field_type is None and field.name in self.types:
+                field_type = pyarrow.type_for_alias(self.types[field.name])
+            if field_type is None:
+                if not force:
+                    return None
+                field_type = pyarrow.string()
+            fields.append(pyarrow.field(field.name, field_type))
+        return pyarrow.schema(fields)
+
+    def _write_pending(self):
+        now = time.time()
+        if self.writer is not None and self.rotate_at is not None and now >= self.rotate_at:
+            self._close_writer()
+        if self.writer is None:
+            self._open_writer(now)
+        for table in self.pending:
+            self.writer.write_table(table.cast(self.schema))
+        self.pending.clear()
+
+    def _open_writer(self, now):
+        filename = self.out_file
+        if self.rotate_interval is not None:
+            start = segment_start(now, self.rotate_interval)
+            # These formats can't be appended to, so don't replace a file left
+            # by a prior run.
+            index = 0
+            filename = segment_filename(self.out_file, start)
+            while os.path.exists(filename):
+                index += 1
+                filename = segment_filename(self.out_file, start, index)
+            self.rotate_at = start + self.rotate_interval
+        if self.format == "parquet":
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        else:
+            import pyarrow.ipc
+            self.sink = open(filename, "wb") if filename else sys.stdout.buffer
+            self.writer = pyarrow.ipc.new_stream(self.sink, self.schema)
+
+    def _close_writer(self):
+        self.writer.close()
+        self.writer = None
+        if self.sink is sys.stdout.buffer:
+            self.sink.flush()
+        elif self.sink is not None:
+            self.sink.close()
+        self.sink = None
+
+    def flush(self):
+        if self.sink is not None:
+            self.sink.flush()
+
+    def close(self):
+        if self.pending:
+            if self.schema is None:
+                self.schema = self._infer_schema(True)
+            self._write_pending()
+        if self.writer is not None:
+            self._close_writer()
+
+
+def loop_body_records(opts, gstate, get_data):
+    now = int(time.time())
+    record = {}
+
+    def cb_add_item(name, val, category):
+        record[name] = val
+
+    def cb_add_sequence(name, val, category, start):
+        for i, subval in enumerate(val, start=start):
+            record["{0}_{1}".format(name, i)] = subval
+
+    def cb_add_bulk(bulk, count, timestamp, counter):
+        gstate.writer.write(timestamp + 1, count, bulk)
+
+    rc = get_data(opts, gstate, cb_add_item, cb_add_sequence, add_bulk=cb_add_bulk)
+
+    if record:
+        gstate.writer.write(now, 1, {key: [val] for key, val in record.items()})
+
+    # Columnar output files can't be read until they have been closed, so
+    # for those, the state file only gets saved on shutdown.
+    columnar = opts.format in COLUMNAR_FORMATS
+    if opts.loop_interval > 0.0 or opts.state_file and not columnar:
+        gstate.writer.flush()
+    if not columnar:
+        dish_common.save_bulk_state(opts, gstate)
+
+    return rc
+
 
-    print(",".join(header))
+def loop_body(opts, gstate, get_data=dish_common.get_data):
+    if isinstance(gstate.out, RotatingFile):
+        gstate.out.rotate_if_due()
 
+    if opts.format != "csv":
+        return loop_body_records(opts, gstate, get_data)
+
+    out = gstate.out
 
-def loop_body(opts, gstate):
     if opts.verbose:
         csv_data = []
     else:
@@ -110,7 +601,7 @@ def loop_body(opts, gstate):
             if name == "state" and val == "DISH_UNREACHABLE":
                 csv_data.extend(["", "", "", val])
             else:
-                csv_data.append(str(val))
+                csv_data.append("" if val is None else str(val))
 
     def cb_data_add_sequence(name, val, category, start):
         if opts.verbose:
@@ -123,48 +614,101 @@ def loop_body(opts, gstate):
         if opts.verbose:
             print("Time range (UTC):      {0} -> {1}".format(
                 datetime.fromtimestamp(timestamp).isoformat(),
-                datetime.fromtimestamp(timestamp + count).isoformat()))
+                datetime.fromtimestamp(timestamp + count).isoformat()),
+                  file=out)
             for key, val in bulk.items():
-                print("{0:22} {1}".format(key + ":", ", ".join(str(subval) for subval in val)))
+                print("{0:22} {1}".format(key + ":", ", ".join(str(subval) for subval in val)),
+                      file=out)
             if opts.loop_interval > 0.0:
-                print()
+                print(file=out)
         else:
-            for i in range(count):
-                timestamp += 1
-                fields = [datetime.fromtimestamp(timestamp).isoformat()]
-                fields.extend(["" if val[i] is None else str(val[i]) for val in bulk.values()])
-                print(",".join(fields))
-
-    rc = dish_common.get_data(opts,
-                              gstate,
-                              cb_data_add_item,
-                              cb_data_add_sequence,
-                              add_bulk=cb_add_bulk)
+            # csv writes None as empty string, same as the other output
+            gstate.bulk_writer.writerows(zip(bulk_timestamps(timestamp, count), *bulk.values()))
+
+    rc = get_data(opts, gstate, cb_data_add_item, cb_data_add_sequence, add_bulk=cb_add_bulk)
 
     if opts.verbose:
         if csv_data:
-            print("\n".join(csv_data))
+            print("\n".join(csv_data), file=out)
             if opts.loop_interval > 0.0:
-                print()
+                print(file=out)
     else:
         # skip if only timestamp
         if len(csv_data) > 1:
-            print(",".join(csv_data))
+            print(",".join(csv_data), file=out)
+
+    if opts.loop_interval > 0.0 or opts.state_file:
+        out.flush()
+    dish_common.save_bulk_state(opts, gstate)
 
     return rc
 
 
+def setup(opts, gstate):
+    """Open the output file, if any, and set up the output format writer."""
+    gstate.out = None
+    gstate.writer = None
+    if opts.format in COLUMNAR_FORMATS:
+        # the writer opens its own output files
+        if opts.bulk_mode:
+            gstate.writer = ArrowWriter(opts, types=BULK_FIELD_TYPES)
+        else:
+            gstate.writer = ArrowWriter(opts, header_fields(opts)[1:])
+        return
+
+    if opts.rotate:
+        header = None
+        if opts.format == "csv" and not opts.verbose:
+            header = ",".join(header_fields(opts))
+        gstate.out = RotatingFile(opts.out_file,
+                                  interval=opts.rotate_interval,
+                                  size=opts.rotate_size * 1e6 if opts.rotate_size else None,
+                                  compress=opts.compress,
+                                  header=header)
+    elif opts.out_file:
+        gstate.out = open(opts.out_file, "a")
+    else:
+        gstate.out = sys.stdout
+    if opts.format == "ndjson":
+        gstate.writer = NdjsonWriter(gstate.out)
+    gstate.bulk_writer = csv.writer(gstate.out, lineterminator="\n")
+
+
+def shutdown(opts, gstate):
+    """Finish writing and close the output file, if any.
+
+    Returns:
+        1 if there was a failure writing the output file, otherwise 0.
+    """
+    try:
+        if gstate.writer is not None:
+            gstate.writer.close()
+        if gstate.out is not None and gstate.out is not sys.stdout:
+            gstate.out.close()
+    except OSError as e:
+        logging.error("Failed writing output file: %s", str(e))
+        return 1
+    dish_common.save_bulk_state(opts, gstate)
+    return 0
+
+
 def main():
     opts = parse_args()
 
     logging.basicConfig(format="%(levelname)s: %(message)s")
 
-    if opts.print_header:
-        print_header(opts)
-        sys.exit(0)
+    gstate = dish_common.GlobalState(opts)
+    try:
+        setup(opts, gstate)
+    except OSError as e:
+        logging.error("Failed opening output file: %s", str(e))
+        sys.exit(1)
 
-    gstate = dish_common.GlobalState()
+    if opts.print_header:
+        print_header(opts, gstate.out)
+        sys.exit(shutdown(opts, gstate))
 
+    rc = 0
     try:
         next_loop = time.monotonic()
         while True:
@@ -176,6 +720,7 @@ def main():
             else:
                 break
     finally:
+        rc = max(rc, shutdown(opts, gstate))
         gstate.shutdown()
 
     sys.exit(rc)
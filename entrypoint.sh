@@ -1,13 +1,38 @@
 #!/bin/sh
 
+# Generated protocol modules are cached under a directory named for the hash
+# of the protoset reflected from the dish, so they only need to be generated
+# again when the dish firmware changes the protocol definitions.
+PROTO_CACHE=${PROTO_CACHE:-/var/cache/starlink-grpc}
+PROTO_FILES="spacex/api/device/device.proto
+spacex/api/common/status/status.proto
+spacex/api/device/command.proto
+spacex/api/device/common.proto
+spacex/api/device/dish.proto
+spacex/api/device/wifi.proto
+spacex/api/device/wifi_config.proto"
+
+mkdir -p "$PROTO_CACHE"
+if grpcurl -plaintext -protoset-out "$PROTO_CACHE/dish.protoset.new" 192.168.100.1:9200 describe SpaceX.API.Device.Device > /dev/null; then
+    PROTO_HASH=$(sha256sum "$PROTO_CACHE/dish.protoset.new" | cut -c1-16)
+    if [ ! -d "$PROTO_CACHE/$PROTO_HASH" ]; then
+        echo "Generating protocol modules for protoset $PROTO_HASH"
+        rm -rf "$PROTO_CACHE/build"
+        mkdir -p "$PROTO_CACHE/build"
+        python3 -m grpc_tools.protoc --descriptor_set_in="$PROTO_CACHE/dish.protoset.new" --python_out="$PROTO_CACHE/build" --grpc_python_out="$PROTO_CACHE/build" $PROTO_FILES || exit 1
+        mv "$PROTO_CACHE/dish.protoset.new" "$PROTO_CACHE/build/dish.protoset"
+        mv "$PROTO_CACHE/build" "$PROTO_CACHE/$PROTO_HASH"
+    fi
+    rm -f "$PROTO_CACHE/dish.protoset.new"
+    ln -snf "$PROTO_HASH" "$PROTO_CACHE/current"
+elif [ -d "$PROTO_CACHE/current" ]; then
+    echo "Dish not reachable, using cached protocol modules for protoset $(readlink "$PROTO_CACHE/current")"
+else
+    echo "Dish not reachable and no cached protocol modules available"
+    exit 1
+fi
+export PYTHONPATH="$PROTO_CACHE/current${PYTHONPATH:+:$PYTHONPATH}"
+
 printenv >> /etc/environment
 ln -snf /usr/share/zoneinfo/$TZ /etc/localtime && echo $TZ > /etc/timezone
-grpcurl -plaintext -protoset-out dish.protoset 192.168.100.1:9200 describe SpaceX.API.Device.Device > /dev/null
-python3 -m grpc_tools.protoc --descriptor_set_in=dish.protoset --python_out=. --grpc_python_out=. spacex/api/device/device.proto
-python3 -m grpc_tools.protoc --descriptor_set_in=dish.protoset --python_out=. --grpc_python_out=. spacex/api/common/status/status.proto
-python3 -m grpc_tools.protoc --descriptor_set_in=dish.protoset --python_out=. --grpc_python_out=. spacex/api/device/command.proto
-python3 -m grpc_tools.protoc --descriptor_set_in=dish.protoset --python_out=. --grpc_python_out=. spacex/api/device/common.proto
-python3 -m grpc_tools.protoc --descriptor_set_in=dish.protoset --python_out=. --grpc_python_out=. spacex/api/device/dish.proto
-python3 -m grpc_tools.protoc --descriptor_set_in=dish.protoset --python_out=. --grpc_python_out=. spacex/api/device/wifi.proto
-python3 -m grpc_tools.protoc --descriptor_set_in=dish.protoset --python_out=. --grpc_python_out=. spacex/api/device/wifi_config.proto
 exec /usr/local/bin/python3 $@
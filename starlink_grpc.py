@@ -105,6 +105,11 @@ General history data
 --------------------
 This set of fields contains data relevant to all the other history groups.
 
+The history statistics groups (ping drop, ping drop run length, and ping
+latency) can all be computed together in a single pass over the history data
+by history_stats, which is cheaper than calling history_ping_stats and
+history_latency_stats separately.
+
 The sample interval is currently 1 second.
 
 : **samples** : The number of samples analyzed (for statistics) or returned
@@ -208,9 +213,35 @@ of stats, even if they happen at the beginning or end of a run of 100% ping
 drop samples. To compute the amount of time that experienced ping loss in less
 than a single run of 100% ping drop, use (*total_ping_drop* -
 *count_full_ping_drop*) from the ping drop stats.
+
+Ping latency history statistics
+-------------------------------
+This group of statistics characterizes the distribution of round trip
+latency. Samples that experienced 100% ping drop have no latency value, so
+are not included. If there are no samples with a latency value, all of the
+statistics other than the histogram will be None.
+
+: **mean_ping_latency** : The mean latency, in milliseconds.
+: **p50_ping_latency** : The median latency, in milliseconds.
+: **p90_ping_latency** : The 90th percentile latency, in milliseconds.
+: **p99_ping_latency** : The 99th percentile latency, in milliseconds.
+: **max_ping_latency** : The highest latency, in milliseconds.
+: **ping_latency_histogram** : A 12 element sequence. Each element records
+    the number of samples with latency in a fixed range of values, in
+    milliseconds. The ranges are: [0, 20], (20, 30], (30, 40], (40, 50],
+    (50, 60], (60, 80], (80, 100], (100, 150], (150, 200], (200, 300],
+    (300, 500], and over 500.
+
+Percentiles are computed using the nearest-rank method, so are always equal
+to one of the sample values.
 """
 
+from bisect import bisect_left
 from itertools import chain
+import math
+import random
+import threading
+import time
 
 import grpc
 
@@ -225,6 +256,8 @@ class GrpcError(Exception):
         # a Call object, and that class has some minimally useful info.
         if isinstance(e, grpc.Call):
             msg = e.details()
+        elif isinstance(e, CircuitOpenError):
+            msg = str(e)
         elif isinstance(e, grpc.RpcError):
             msg = "Unknown communication or service error"
         else:
@@ -232,23 +265,365 @@ class GrpcError(Exception):
         super().__init__(msg, *args, **kwargs)
 
 
+# Upper bounds of the ping latency histogram buckets, in milliseconds. There
+# is one more bucket than bounds, for latency above the highest bound.
+LATENCY_HISTOGRAM_BOUNDS = (20, 30, 40, 50, 60, 80, 100, 150, 200, 300, 500)
+
+# Default maximum age, in seconds, of cached responses, per request type. This
+# is just under the sample interval, so that callers polling once per sample
+# interval will always get fresh data.
+CACHE_TTL_DEFAULT = {
+    "get_status": 0.9,
+    "get_history": 0.9,
+}
+
+
+# Base and maximum delay, in seconds, between retries of a failed request. The
+# delay doubles on each retry, with random jitter.
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_MAX = 10.0
+
+# Time, in seconds, to wait for a keepalive ping to be acknowledged before
+# considering the connection dead.
+KEEPALIVE_TIMEOUT = 5.0
+
+
+class CircuitOpenError(grpc.RpcError):
+    """Raised instead of sending a request while the circuit breaker is open.
+
+    See ChannelContext for detail.
+    """
+
+
+class _CircuitBreaker:
+    """Fail requests fast after too many consecutive failures.
+
+    Once open, requests are failed without being sent until reset_time has
+    passed, after which requests are sent again, but another failure will
+    open it again immediately.
+    """
+    def __init__(self, threshold, reset_time):
+        self.threshold = threshold
+        self.reset_time = reset_time
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.open_until = 0.0
+
+    def check(self):
+        with self.lock:
+            if self.failures >= self.threshold and time.monotonic() < self.open_until:
+                raise CircuitOpenError(
+                    "Not sending request after {0} consecutive failures".format(self.failures))
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.open_until = time.monotonic() + self.reset_time
+
+
+def _retry_delay(attempt):
+    delay = min(RETRY_BACKOFF_BASE * 2.0**attempt, RETRY_BACKOFF_MAX)
+    return random.uniform(delay / 2.0, delay)
+
+
+class _PendingResponse:
+    """A request in flight, for other callers to wait on instead of issuing
+    their own request."""
+    def __init__(self):
+        self.started = time.monotonic()
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class _ResponseCache:
+    """A cache of recent responses to each request type.
+
+    Concurrent requests of the same type are coalesced, such that only one is
+    sent to the dish and the rest wait for the response to that one.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.pending = {}
+
+    def get(self, request_name, fetch, max_age=None):
+        if max_age is None:
+            max_age = self.ttl.get(request_name, 0.0)
+        while True:
+            asked = time.monotonic()
+            with self.lock:
+                entry = self.entries.get(request_name)
+                if entry is not None and asked - entry[0] <= max_age:
+                    return entry[1]
+                waiting = self.pending.get(request_name)
+                if waiting is None:
+                    waiting = _PendingResponse()
+                    self.pending[request_name] = waiting
+                    break
+
+            waiting.done.wait()
+            # A request that was sent before this one was asked for may still
+            # be too old. If so, go around again. Same if it was a prefetch
+            # that failed, so that the request gets retried as usual.
+            if asked - waiting.started <= max_age:
+                if waiting.error is not None:
+                    raise waiting.error
+                if waiting.response is not None:
+                    return waiting.response
+
+        try:
+            waiting.response = fetch()
+        except Exception as e:
+            waiting.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.pending[request_name]
+                if waiting.error is None:
+                    self.entries[request_name] = (waiting.started, waiting.response)
+            waiting.done.set()
+
+        return waiting.response
+
+    def start(self, request_name, send):
+        """Send a request without waiting for the response.
+
+        The request is not sent if a fresh enough response is already cached
+        or a request is already pending. If the request fails, the next get
+        will send it again, so that it gets retried as usual.
+
+        Args:
+            request_name (str): The request type.
+            send (function): Function that sends the request and returns a
+                grpc.Future for the response.
+        """
+        with self.lock:
+            entry = self.entries.get(request_name)
+            if entry is not None and time.monotonic() - entry[0] <= self.ttl.get(
+                    request_name, 0.0):
+                return
+            if request_name in self.pending:
+                return
+            waiting = _PendingResponse()
+            self.pending[request_name] = waiting
+
+        def finish(future):
+            try:
+                waiting.response = future.result()
+            except Exception:
+                pass
+            # The response is only needed because the caller is about to ask
+            # for it, so count its age from when it was received.
+            waiting.started = time.monotonic()
+            with self.lock:
+                del self.pending[request_name]
+                if waiting.response is not None:
+                    self.entries[request_name] = (waiting.started, waiting.response)
+            waiting.done.set()
+
+        try:
+            future = send()
+        except Exception:
+            with self.lock:
+                del self.pending[request_name]
+            waiting.done.set()
+            return
+        future.add_done_callback(finish)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class _PooledChannel:
+    """A channel in a ChannelContext's pool, along with its usage count."""
+    def __init__(self, channel):
+        self.channel = channel
+        self.users = 0
+        self.retired = False
+
+
 class ChannelContext:
-    """A wrapper for reusing an open grpc Channel across calls."""
-    def __init__(self, target="192.168.100.1:9200"):
-        self.channel = None
+    """A wrapper for reusing open grpc Channels across calls.
+
+    This is safe to share between threads. Optionally, it can keep a pool of
+    more than one channel, so that concurrent requests from different threads
+    can be spread across them. When a request fails, only the channel it used
+    is replaced, and that channel is not closed until all other requests in
+    progress on it have finished.
+
+    Optionally, this can also cache responses, so that multiple consumers of
+    the same data within a short period of time need only a single request to
+    the dish.
+
+    By default, requests have no time limit and a failed request is retried
+    only if it was sent on a channel that was already open, since
+    connectivity may have been lost and restored since it was last used. The
+    remaining args can be used to bound the time a request can take, in
+    which case the worst case time is roughly (retries + 2) * timeout plus
+    the retry delays.
+
+    Args:
+        target (str): The host:port to connect to.
+        cache (bool): Optionally enable response caching.
+        cache_ttl (dict): Optionally override the default maximum age, in
+            seconds, of cached responses for specific request types. Keys are
+            request names, such as "get_status" or "get_history". Ignored
+            unless cache is set.
+        timeout (float): Optionally, the deadline, in seconds, for each
+            request attempt.
+        keepalive (float): Optionally, the interval, in seconds, at which to
+            send keepalive pings on the channel while a request is in
+            progress, so that a dead connection is detected during a long
+            running request. No pings are sent while the channel is idle, and
+            this does not limit how long a request can take; timeout is what
+            does that. gRPC servers by default do not allow pings more often
+            than every 5 minutes, or at all while no request is in progress,
+            and will drop the connection of a client that does so repeatedly.
+        wait_for_ready (bool): Optionally, if the dish is not reachable, wait
+            for it to become reachable instead of failing immediately. This
+            requires timeout to be set, which then caps the wait.
+        retries (int): Optionally, the number of times to retry a failed
+            request, in addition to the retry on a reused channel, with
+            exponential backoff and jitter between attempts.
+        breaker_threshold (int): Optionally, the number of consecutive failed
+            requests after which further requests will fail immediately with
+            CircuitOpenError, without being sent, until breaker_reset seconds
+            have passed.
+        breaker_reset (float): The time, in seconds, for which requests will
+            fail immediately once breaker_threshold has been reached.
+        pool_size (int): Optionally, the maximum number of channels to keep
+            open.
+    """
+    def __init__(self,
+                 target="192.168.100.1:9200",
+                 cache=False,
+                 cache_ttl=None,
+                 timeout=None,
+                 keepalive=None,
+                 wait_for_ready=False,
+                 retries=0,
+                 breaker_threshold=None,
+                 breaker_reset=30.0,
+                 pool_size=1):
+        if wait_for_ready and timeout is None:
+            raise ValueError("wait_for_ready requires timeout to be set")
+        self.lock = threading.Lock()
+        self.pool = []
+        self.pool_size = max(pool_size, 1)
+        self.in_use = {}
+        self.next_index = 0
         self.target = target
+        self.cache = None
+        if cache:
+            ttl = dict(CACHE_TTL_DEFAULT)
+            if cache_ttl is not None:
+                ttl.update(cache_ttl)
+            self.cache = _ResponseCache(ttl)
+        self.timeout = timeout
+        self.wait_for_ready = wait_for_ready or None
+        self.retries = retries
+        self.options = []
+        if keepalive is not None:
+            self.options = [
+                ("grpc.keepalive_time_ms", int(keepalive * 1000)),
+                ("grpc.keepalive_timeout_ms", int(KEEPALIVE_TIMEOUT * 1000)),
+                ("grpc.http2.max_pings_without_data", 0),
+            ]
+        self.breaker = None
+        if breaker_threshold is not None:
+            self.breaker = _CircuitBreaker(breaker_threshold, breaker_reset)
+
+    def acquire_channel(self):
+        """Get a channel from the pool to use for a request.
+
+        The channel must be returned with release_channel once the request
+        has finished.
+
+        Returns:
+            A tuple with the grpc Channel and a flag indicating whether it was
+            already open.
+        """
+        with self.lock:
+            if len(self.pool) < self.pool_size:
+                pooled = _PooledChannel(grpc.insecure_channel(self.target, options=self.options))
+                self.pool.append(pooled)
+                reused = False
+            else:
+                pooled = self.pool[self.next_index % len(self.pool)]
+                self.next_index += 1
+                reused = True
+            pooled.users += 1
+            self.in_use[pooled.channel] = pooled
+        return pooled.channel, reused
+
+    def release_channel(self, channel, failed=False):
+        """Return a channel previously obtained from acquire_channel.
+
+        Args:
+            channel (grpc.Channel): The channel.
+            failed (bool): Optionally indicate that the request failed, in
+                which case the channel will be replaced with a new one.
+        """
+        with self.lock:
+            pooled = self.in_use[channel]
+            pooled.users -= 1
+            if not pooled.users:
+                del self.in_use[channel]
+            if failed:
+                self._retire(pooled)
+            close = pooled.retired and not pooled.users
+        if close:
+            channel.close()
+
+    def _retire(self, pooled):
+        # must be called with lock held
+        if not pooled.retired:
+            pooled.retired = True
+            self.pool.remove(pooled)
 
     def get_channel(self):
-        reused = True
-        if self.channel is None:
-            self.channel = grpc.insecure_channel(self.target)
-            reused = False
-        return self.channel, reused
+        """Get a channel from the pool, without reserving it for a request.
+
+        Returns:
+            A tuple with the grpc Channel and a flag indicating whether it was
+            already open.
+        """
+        channel, reused = self.acquire_channel()
+        self.release_channel(channel)
+        return channel, reused
 
     def close(self):
-        if self.channel is not None:
-            self.channel.close()
-        self.channel = None
+        with self.lock:
+            idle = []
+            for pooled in list(self.pool):
+                self._retire(pooled)
+                if not pooled.users:
+                    idle.append(pooled.channel)
+        for channel in idle:
+            channel.close()
+        if self.cache is not None:
+            self.cache.clear()
+
+
+_alert_fields_cache = None
+
+
+def _alert_fields():
+    # Walking the message descriptor is relatively slow, and it won't change
+    # once loaded, so only do it once, and only when actually needed.
+    global _alert_fields_cache
+    if _alert_fields_cache is None:
+        _alert_fields_cache = [(field.name, field.index)
+                               for field in spacex.api.device.dish_pb2.DishAlerts.DESCRIPTOR.fields]
+    return _alert_fields_cache
 
 
 def status_field_names():
@@ -262,9 +637,7 @@ def status_field_names():
         second with obstruction detail field names, and the third with alert
         detail field names.
     """
-    alert_names = []
-    for field in spacex.api.device.dish_pb2.DishAlerts.DESCRIPTOR.fields:
-        alert_names.append("alert_" + field.name)
+    alert_names = ["alert_" + name for name, _ in _alert_fields()]
 
     return [
         "id",
@@ -287,14 +660,102 @@ def status_field_names():
     ], alert_names
 
 
-def get_status(context=None):
+def _handle_request(context, request_name):
+    if context.breaker is not None:
+        context.breaker.check()
+    attempt = 0
+    while True:
+        channel, reused = context.acquire_channel()
+        try:
+            stub = spacex.api.device.device_pb2_grpc.DeviceStub(channel)
+            response = stub.Handle(spacex.api.device.device_pb2.Request(**{request_name: {}}),
+                                   timeout=context.timeout,
+                                   wait_for_ready=context.wait_for_ready)
+        except grpc.RpcError:
+            context.release_channel(channel, failed=True)
+            if reused:
+                continue
+            if attempt >= context.retries:
+                if context.breaker is not None:
+                    context.breaker.failed()
+                raise
+            time.sleep(_retry_delay(attempt))
+            attempt += 1
+            continue
+        context.release_channel(channel)
+        if context.breaker is not None:
+            context.breaker.succeeded()
+        return response
+
+
+def prefetch(context, request_names):
+    """Start requests without waiting for their responses.
+
+    This allows multiple requests to be in flight at the same time. The
+    responses are stored in the response cache, so that a subsequent call to
+    get_status or get_history, or any of the functions that use them, will
+    wait for and use the prefetched response instead of sending a new
+    request. Prefetched responses are considered to be as old as the time they
+    were received, rather than the time they were requested.
+
+    If a prefetched request fails, the subsequent call will send the request
+    again, retrying as usual.
+
+    Args:
+        context (ChannelContext): The channel to use. This must have response
+            caching enabled, otherwise this function does nothing.
+        request_names (list): The request types to send, such as
+            "get_status" or "get_history".
+    """
+    if context.cache is None:
+        return
+    if context.breaker is not None:
+        try:
+            context.breaker.check()
+        except CircuitOpenError:
+            return
+
+    def sender(request_name):
+        def send():
+            channel, _ = context.acquire_channel()
+            try:
+                stub = spacex.api.device.device_pb2_grpc.DeviceStub(channel)
+                future = stub.Handle.future(
+                    spacex.api.device.device_pb2.Request(**{request_name: {}}),
+                    timeout=context.timeout,
+                    wait_for_ready=context.wait_for_ready)
+            except Exception:
+                context.release_channel(channel, failed=True)
+                raise
+            future.add_done_callback(lambda f: context.release_channel(
+                channel, failed=f.cancelled() or f.exception() is not None))
+            return future
+
+        return send
+
+    for request_name in request_names:
+        context.cache.start(request_name, sender(request_name))
+
+
+def _get_response(context, request_name, max_age):
+    if context.cache is None:
+        return _handle_request(context, request_name)
+    return context.cache.get(request_name,
+                             lambda: _handle_request(context, request_name),
+                             max_age=max_age)
+
+
+def get_status(context=None, max_age=None):
     """Fetch status data and return it in grpc structure format.
 
     Args:
         context (ChannelContext): Optionally provide a channel for reuse
-            across repeated calls. If an existing channel is reused, the RPC
-            call will be retried at most once, since connectivity may have
-            been lost and restored in the time since it was last used.
+            across repeated calls. See ChannelContext for detail on how
+            failed requests are retried.
+        max_age (float): Optionally, if context has response caching enabled,
+            the maximum age, in seconds, of a cached response that may be
+            returned instead of making a new request. Defaults to the cache
+            TTL for status requests.
 
     Raises:
         grpc.RpcError: Communication or service error.
@@ -305,24 +766,18 @@ def get_status(context=None):
             response = stub.Handle(spacex.api.device.device_pb2.Request(get_status={}))
         return response.dish_get_status
 
-    while True:
-        channel, reused = context.get_channel()
-        try:
-            stub = spacex.api.device.device_pb2_grpc.DeviceStub(channel)
-            response = stub.Handle(spacex.api.device.device_pb2.Request(get_status={}))
-            return response.dish_get_status
-        except grpc.RpcError:
-            context.close()
-            if not reused:
-                raise
+    return _get_response(context, "get_status", max_age).dish_get_status
 
 
-def get_id(context=None):
+def get_id(context=None, max_age=None):
     """Return the ID from the dish status information.
 
     Args:
         context (ChannelContext): Optionally provide a channel for reuse
             across repeated calls.
+        max_age (float): Optionally, if context has response caching enabled,
+            the maximum age, in seconds, of cached data that may be used. See
+            get_status for detail.
 
     Returns:
         A string identifying the Starlink user terminal reachable from the
@@ -332,18 +787,21 @@ def get_id(context=None):
         GrpcError: No user terminal is currently reachable.
     """
     try:
-        status = get_status(context)
+        status = get_status(context, max_age=max_age)
         return status.device_info.id
     except grpc.RpcError as e:
         raise GrpcError(e)
 
 
-def status_data(context=None):
+def status_data(context=None, max_age=None):
     """Fetch current status data.
 
     Args:
         context (ChannelContext): Optionally provide a channel for reuse
             across repeated calls.
+        max_age (float): Optionally, if context has response caching enabled,
+            the maximum age, in seconds, of cached data that may be used. See
+            get_status for detail.
 
     Returns:
         A tuple with 3 dicts, the first mapping status data names to their
@@ -355,7 +813,7 @@ def status_data(context=None):
             terminal.
     """
     try:
-        status = get_status(context)
+        status = get_status(context, max_age=max_age)
     except grpc.RpcError as e:
         raise GrpcError(e)
 
@@ -364,10 +822,10 @@ def status_data(context=None):
     # DishAlerts message.
     alerts = {}
     alert_bits = 0
-    for field in status.alerts.DESCRIPTOR.fields:
-        value = getattr(status.alerts, field.name)
-        alerts["alert_" + field.name] = value
-        alert_bits |= (1 if value else 0) << (field.index)
+    for name, index in _alert_fields():
+        value = getattr(status.alerts, name)
+        alerts["alert_" + name] = value
+        alert_bits |= (1 if value else 0) << index
 
     return {
         "id": status.device_info.id,
@@ -445,14 +903,40 @@ def history_ping_field_names():
     ]
 
 
-def get_history(context=None):
+def history_latency_field_names():
+    """Return the field names of the ping latency stats.
+
+    Note:
+        See module level docs regarding brackets in field names.
+
+    Returns:
+        A tuple with 2 lists, the first with general data names, the second
+        with ping latency stat names.
+    """
+    return [
+        "samples",
+        "end_counter",
+    ], [
+        "mean_ping_latency",
+        "p50_ping_latency",
+        "p90_ping_latency",
+        "p99_ping_latency",
+        "max_ping_latency",
+        "ping_latency_histogram[{0}]".format(len(LATENCY_HISTOGRAM_BOUNDS) + 1),
+    ]
+
+
+def get_history(context=None, max_age=None):
     """Fetch history data and return it in grpc structure format.
 
     Args:
         context (ChannelContext): Optionally provide a channel for reuse
-            across repeated calls. If an existing channel is reused, the RPC
-            call will be retried at most once, since connectivity may have
-            been lost and restored in the time since it was last used.
+            across repeated calls. See ChannelContext for detail on how
+            failed requests are retried.
+        max_age (float): Optionally, if context has response caching enabled,
+            the maximum age, in seconds, of a cached response that may be
+            returned instead of making a new request. Defaults to the cache
+            TTL for history requests.
 
     Raises:
         grpc.RpcError: Communication or service error.
@@ -463,19 +947,10 @@ def get_history(context=None):
             response = stub.Handle(spacex.api.device.device_pb2.Request(get_history={}))
         return response.dish_get_history
 
-    while True:
-        channel, reused = context.get_channel()
-        try:
-            stub = spacex.api.device.device_pb2_grpc.DeviceStub(channel)
-            response = stub.Handle(spacex.api.device.device_pb2.Request(get_history={}))
-            return response.dish_get_history
-        except grpc.RpcError:
-            context.close()
-            if not reused:
-                raise
+    return _get_response(context, "get_history", max_age).dish_get_history
 
 
-def _compute_sample_range(history, parse_samples, start=None, verbose=False):
+def _compute_sample_ranges(history, parse_samples, start=None, verbose=False):
     current = int(history.current)
     samples = len(history.pop_ping_drop_rate)
 
@@ -504,17 +979,34 @@ def _compute_sample_range(history, parse_samples, start=None, verbose=False):
     end_offset = current % samples
     start_offset = start % samples
 
-    # Set the range for the requested set of samples. This will iterate
-    # sample index in order from oldest to newest.
+    # Set the ranges for the requested set of samples. Iterating through
+    # these in order will iterate sample index in order from oldest to newest.
     if start_offset < end_offset:
-        sample_range = range(start_offset, end_offset)
+        sample_ranges = (range(start_offset, end_offset),)
     else:
-        sample_range = chain(range(start_offset, samples), range(0, end_offset))
+        sample_ranges = (range(start_offset, samples), range(0, end_offset))
+
+    return sample_ranges, current - start, current
+
+
+def _compute_sample_range(history, parse_samples, start=None, verbose=False):
+    sample_ranges, parsed_samples, current = _compute_sample_ranges(history,
+                                                                    parse_samples,
+                                                                    start=start,
+                                                                    verbose=verbose)
+    return chain(*sample_ranges), parsed_samples, current
 
-    return sample_range, current - start, current
 
+def _extract_column(field, sample_ranges):
+    # Slicing the repeated field is much faster than indexing it one sample
+    # at a time.
+    column = []
+    for sample_range in sample_ranges:
+        column.extend(field[sample_range.start:sample_range.stop])
+    return column
 
-def history_bulk_data(parse_samples, start=None, verbose=False, context=None):
+
+def history_bulk_data(parse_samples, start=None, verbose=False, context=None, max_age=None):
     """Fetch history data for a range of samples.
 
     Args:
@@ -535,6 +1027,9 @@ def history_bulk_data(parse_samples, start=None, verbose=False, context=None):
         verbose (bool): Optionally produce verbose output.
         context (ChannelContext): Optionally provide a channel for reuse
             across repeated calls.
+        max_age (float): Optionally, if context has response caching enabled,
+            the maximum age, in seconds, of cached data that may be used. See
+            get_history for detail.
 
     Returns:
         A tuple with 2 dicts, the first mapping general data names to their
@@ -550,7 +1045,7 @@ def history_bulk_data(parse_samples, start=None, verbose=False, context=None):
             terminal.
     """
     try:
-        history = get_history(context)
+        history = get_history(context, max_age=max_age)
     except grpc.RpcError as e:
         raise GrpcError(e)
 
@@ -591,8 +1086,17 @@ def history_bulk_data(parse_samples, start=None, verbose=False, context=None):
     }
 
 
-def history_ping_stats(parse_samples, verbose=False, context=None):
-    """Fetch, parse, and compute the packet loss stats.
+# The groups of history statistics that can be requested from history_stats.
+HISTORY_STATS_GROUPS = ("ping_drop", "ping_run_length", "ping_latency")
+
+
+def history_stats(parse_samples, groups=HISTORY_STATS_GROUPS, verbose=False, context=None,
+                  max_age=None, history=None):
+    """Fetch, parse, and compute history statistics for multiple groups.
+
+    All the requested groups are computed in a single pass over the history
+    data, so this is more efficient than calling the functions for the
+    individual groups separately.
 
     Note:
         See module level docs regarding brackets in field names.
@@ -600,27 +1104,47 @@ def history_ping_stats(parse_samples, verbose=False, context=None):
     Args:
         parse_samples (int): Number of samples to process, or -1 to parse all
             available samples.
+        groups (iterable): The stat groups to compute, any of:
+            "ping_drop", "ping_run_length", "ping_latency". Defaults to all of
+            them.
         verbose (bool): Optionally produce verbose output.
         context (ChannelContext): Optionally provide a channel for reuse
             across repeated calls.
+        max_age (float): Optionally, if context has response caching enabled,
+            the maximum age, in seconds, of cached data that may be used. See
+            get_history for detail.
+        history: Optionally, history data in grpc structure format, as
+            returned by get_history, to use instead of fetching it.
 
     Returns:
-        A tuple with 3 dicts, the first mapping general data names to their
-        values, the second mapping ping drop stat names to their values and
-        the third mapping ping drop run length stat names to their values.
+        A tuple with 2 dicts, the first mapping general data names to their
+        values and the second mapping each requested group name to a dict
+        mapping that group's stat names to their values.
 
     Raises:
         GrpcError: Failed getting history info from the Starlink user
             terminal.
     """
-    try:
-        history = get_history(context)
-    except grpc.RpcError as e:
-        raise GrpcError(e)
+    if history is None:
+        try:
+            history = get_history(context, max_age=max_age)
+        except grpc.RpcError as e:
+            raise GrpcError(e)
+
+    sample_ranges, parse_samples, current = _compute_sample_ranges(history,
+                                                                   parse_samples,
+                                                                   verbose=verbose)
+
+    want_ping = "ping_drop" in groups
+    want_latency = "ping_latency" in groups
 
-    sample_range, parse_samples, current = _compute_sample_range(history,
-                                                                 parse_samples,
-                                                                 verbose=verbose)
+    # Pull out only the columns needed for the requested groups.
+    drop_rates = _extract_column(history.pop_ping_drop_rate, sample_ranges)
+    if want_ping:
+        scheduled = _extract_column(history.scheduled, sample_ranges)
+        obstructed = _extract_column(history.obstructed, sample_ranges)
+    if want_latency:
+        latency_column = _extract_column(history.pop_ping_latency_ms, sample_ranges)
 
     tot = 0.0
     count_full_drop = 0
@@ -636,62 +1160,164 @@ def history_ping_stats(parse_samples, verbose=False, context=None):
     run_length = 0
     init_run_length = None
 
-    for i in sample_range:
-        d = history.pop_ping_drop_rate[i]
+    latencies = []
+    histogram = [0] * (len(LATENCY_HISTOGRAM_BOUNDS) + 1)
+
+    for i, d in enumerate(drop_rates):
         if d >= 1:
             # just in case...
             d = 1
             count_full_drop += 1
             run_length += 1
-        elif run_length > 0:
-            if init_run_length is None:
-                init_run_length = run_length
-            else:
-                if run_length <= 60:
-                    second_runs[run_length - 1] += run_length
+        else:
+            if run_length > 0:
+                if init_run_length is None:
+                    init_run_length = run_length
                 else:
-                    minute_runs[min((run_length-1) // 60 - 1, 59)] += run_length
+                    if run_length <= 60:
+                        second_runs[run_length - 1] += run_length
+                    else:
+                        minute_runs[min((run_length-1) // 60 - 1, 59)] += run_length
+                run_length = 0
+            elif init_run_length is None:
+                init_run_length = 0
+            if want_latency:
+                latency = latency_column[i]
+                latencies.append(latency)
+                histogram[bisect_left(LATENCY_HISTOGRAM_BOUNDS, latency)] += 1
+        if want_ping:
+            if not scheduled[i]:
+                count_unsched += 1
+                total_unsched_drop += d
+                if d >= 1:
+                    count_full_unsched += 1
+            # scheduled=false and obstructed=true do not ever appear to overlap,
+            # but in case they do in the future, treat that as just unscheduled
+            # in order to avoid double-counting it.
+            elif obstructed[i]:
+                count_obstruct += 1
+                total_obstruct_drop += d
+                if d >= 1:
+                    count_full_obstruct += 1
+            tot += d
+
+    stats = {}
+
+    if want_ping:
+        stats["ping_drop"] = {
+            "total_ping_drop": tot,
+            "count_full_ping_drop": count_full_drop,
+            "count_obstructed": count_obstruct,
+            "total_obstructed_ping_drop": total_obstruct_drop,
+            "count_full_obstructed_ping_drop": count_full_obstruct,
+            "count_unscheduled": count_unsched,
+            "total_unscheduled_ping_drop": total_unsched_drop,
+            "count_full_unscheduled_ping_drop": count_full_unsched,
+        }
+
+    if "ping_run_length" in groups:
+        # If the entire sample set is one big drop run, it will be both initial
+        # fragment (continued from prior sample range) and final one (continued
+        # to next sample range), but to avoid double-reporting, just call it
+        # the initial run.
+        if init_run_length is None:
+            init_run_length = run_length
             run_length = 0
-        elif init_run_length is None:
-            init_run_length = 0
-        if not history.scheduled[i]:
-            count_unsched += 1
-            total_unsched_drop += d
-            if d >= 1:
-                count_full_unsched += 1
-        # scheduled=false and obstructed=true do not ever appear to overlap,
-        # but in case they do in the future, treat that as just unscheduled
-        # in order to avoid double-counting it.
-        elif history.obstructed[i]:
-            count_obstruct += 1
-            total_obstruct_drop += d
-            if d >= 1:
-                count_full_obstruct += 1
-        tot += d
-
-    # If the entire sample set is one big drop run, it will be both initial
-    # fragment (continued from prior sample range) and final one (continued
-    # to next sample range), but to avoid double-reporting, just call it
-    # the initial run.
-    if init_run_length is None:
-        init_run_length = run_length
-        run_length = 0
+        stats["ping_run_length"] = {
+            "init_run_fragment": init_run_length,
+            "final_run_fragment": run_length,
+            "run_seconds[1,]": second_runs,
+            "run_minutes[1,]": minute_runs,
+        }
+
+    if want_latency:
+        # Sorting is done once, in native code, and then all the percentiles
+        # can be read directly out of the sorted list.
+        latencies.sort()
+        if latencies:
+            latency_stats = {
+                "mean_ping_latency": math.fsum(latencies) / len(latencies),
+                "p50_ping_latency": _nearest_rank(latencies, 0.5),
+                "p90_ping_latency": _nearest_rank(latencies, 0.9),
+                "p99_ping_latency": _nearest_rank(latencies, 0.99),
+                "max_ping_latency": latencies[-1],
+            }
+        else:
+            latency_stats = dict.fromkeys(
+                ("mean_ping_latency", "p50_ping_latency", "p90_ping_latency", "p99_ping_latency",
+                 "max_ping_latency"))
+        latency_stats["ping_latency_histogram[]"] = histogram
+        stats["ping_latency"] = latency_stats
 
     return {
         "samples": parse_samples,
         "end_counter": current,
-    }, {
-        "total_ping_drop": tot,
-        "count_full_ping_drop": count_full_drop,
-        "count_obstructed": count_obstruct,
-        "total_obstructed_ping_drop": total_obstruct_drop,
-        "count_full_obstructed_ping_drop": count_full_obstruct,
-        "count_unscheduled": count_unsched,
-        "total_unscheduled_ping_drop": total_unsched_drop,
-        "count_full_unscheduled_ping_drop": count_full_unsched,
-    }, {
-        "init_run_fragment": init_run_length,
-        "final_run_fragment": run_length,
-        "run_seconds[1,]": second_runs,
-        "run_minutes[1,]": minute_runs,
-    }
+    }, stats
+
+
+def _nearest_rank(sorted_values, fraction):
+    return sorted_values[max(math.ceil(len(sorted_values) * fraction) - 1, 0)]
+
+
+def history_ping_stats(parse_samples, verbose=False, context=None, max_age=None):
+    """Fetch, parse, and compute the packet loss stats.
+
+    Note:
+        See module level docs regarding brackets in field names.
+
+    Args:
+        parse_samples (int): Number of samples to process, or -1 to parse all
+            available samples.
+        verbose (bool): Optionally produce verbose output.
+        context (ChannelContext): Optionally provide a channel for reuse
+            across repeated calls.
+        max_age (float): Optionally, if context has response caching enabled,
+            the maximum age, in seconds, of cached data that may be used. See
+            get_history for detail.
+
+    Returns:
+        A tuple with 3 dicts, the first mapping general data names to their
+        values, the second mapping ping drop stat names to their values and
+        the third mapping ping drop run length stat names to their values.
+
+    Raises:
+        GrpcError: Failed getting history info from the Starlink user
+            terminal.
+    """
+    general, stats = history_stats(parse_samples, ("ping_drop", "ping_run_length"),
+                                   verbose=verbose,
+                                   context=context,
+                                   max_age=max_age)
+    return general, stats["ping_drop"], stats["ping_run_length"]
+
+
+def history_latency_stats(parse_samples, verbose=False, context=None, max_age=None):
+    """Fetch, parse, and compute the ping latency stats.
+
+    Note:
+        See module level docs regarding brackets in field names.
+
+    Args:
+        parse_samples (int): Number of samples to process, or -1 to parse all
+            available samples.
+        verbose (bool): Optionally produce verbose output.
+        context (ChannelContext): Optionally provide a channel for reuse
+            across repeated calls.
+        max_age (float): Optionally, if context has response caching enabled,
+            the maximum age, in seconds, of cached data that may be used. See
+            get_history for detail.
+
+    Returns:
+        A tuple with 2 dicts, the first mapping general data names to their
+        values and the second mapping ping latency stat names to their
+        values.
+
+    Raises:
+        GrpcError: Failed getting history info from the Starlink user
+            terminal.
+    """
+    general, stats = history_stats(parse_samples, ("ping_latency",),
+                                   verbose=verbose,
+                                   context=context,
+                                   max_age=max_age)
+    return general, stats["ping_latency"]
@@ -0,0 +1,376 @@
+"""Shared memory snapshot of Starlink user terminal data.
+
+This module implements a file format for publishing the most recent status
+data and a rolling window of bulk history data from a Starlink user terminal
+to any number of other programs on the same host, without each of them having
+to talk to the user terminal itself. One program, such as the
+dish_grpc_snapshot.py script, writes the data using SnapshotWriter, and the
+others read it using SnapshotReader, by way of a memory-mapped file.
+
+The file should live on a memory-backed file system, such as /dev/shm on
+Linux, so that updating it does not involve any disk I/O. Readers do not need
+any of the gRPC or protocol modules, only the Python standard library.
+
+File format
+-----------
+The file starts with a fixed size header, packed as HEADER_FORMAT:
+
+: **magic** : FILE_MAGIC, identifying the file format.
+: **version** : FILE_VERSION.
+: **layout_offset** : Offset of the layout description, which is also the
+    size of the header.
+: **sequence** : Sequence number, incremented before and after each update,
+    so it is odd while an update is in progress. See below.
+: **update_time** : Time of the last update, in seconds since the Unix epoch.
+: **end_timestamp** : Time of the most recent bulk history sample, in seconds
+    since the Unix epoch, or 0 if there are none.
+: **end_counter** : Sample counter value of the most recent bulk history
+    sample.
+: **status_length** : Length of the status data.
+: **window_count** : Number of bulk history samples currently held.
+: **window_head** : Index in the bulk history columns at which the next
+    sample will be written.
+: **layout_length** : Length of the layout description.
+
+The layout description is a JSON object, written once when the file is
+created, with the following keys:
+
+: **window** : The maximum number of bulk history samples held.
+: **columns** : List of the bulk history field names. See the starlink_grpc
+    module docs for detail on each of them.
+: **status_offset** : Offset of the status data.
+: **status_size** : Space available for the status data.
+: **columns_offset** : Offset of the first bulk history column.
+
+The status data is a JSON object with the dish ID under "id" and the status
+and history stats fields from the most recently polled modes under "status"
+and "ping_stats", respectively. Sequence fields are stored as lists.
+
+Each bulk history column is a ring buffer of window 8 byte little endian
+floating point values, one column after the other. Missing values are stored
+as NaN and boolean values as 1.0 or 0.0. The samples held are always
+consecutive, with the oldest at index window_head - window_count, modulo
+window, and the newest at window_head - 1, which is the sample at
+end_timestamp and end_counter.
+
+Consistency
+-----------
+The writer updates the file in place, seqlock style: It increments the
+sequence number to an odd value, updates the data, then increments it to an
+even value. A reader that reads the same even sequence number before and
+after copying out the data knows it got a consistent snapshot, and otherwise
+tries again. When the writer starts up, it creates a new file and renames it
+over the old one, so readers should check whether the file has been replaced,
+as SnapshotReader does.
+"""
+
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from array import array
+
+FILE_MAGIC = b"STRLKSNP"
+FILE_VERSION = 1
+HEADER_FORMAT = "<8sIIQdqQIIII"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+SEQUENCE_OFFSET = 16
+WINDOW_DEFAULT = 900
+STATUS_SIZE_DEFAULT = 65536
+# How many times to try reading before giving up on getting a consistent
+# snapshot, and how long to wait between tries, in seconds
+READ_TRIES = 100
+READ_RETRY_DELAY = 0.001
+# Byte order of the column values, as expected by array
+LITTLE_ENDIAN = sys.byteorder == "little"
+
+
+def default_filename():
+    """Return the file name used by default for the snapshot file."""
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, "starlink.snapshot")
+
+
+class SnapshotError(Exception):
+    """Provides error info when a snapshot could not be read or written."""
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _float_or_nan(val):
+    return math.nan if val is None else float(val)
+
+
+class SnapshotWriter:
+    """Write status data and a window of bulk history to a snapshot file.
+
+    Args:
+        filename (str): The file to write. It will be replaced if it already
+            exists.
+        columns (list): The bulk history field names.
+        window (int): The maximum number of bulk history samples to hold.
+        status_size (int): Space to allow for the status data, in bytes.
+    """
+    def __init__(self, filename, columns, window=WINDOW_DEFAULT, status_size=STATUS_SIZE_DEFAULT):
+        self.columns = list(columns)
+        self.window = window
+        self.status_size = status_size
+        self.sequence = 0
+        self.update_time = 0.0
+        self.end_timestamp = 0
+        self.end_counter = 0
+        self.status_length = 0
+        self.count = 0
+        self.head = 0
+
+        self.status_offset = None
+        layout = b""
+        # The offsets depend on the layout length, so settle on them first.
+        while True:
+            status_offset = _align(HEADER_SIZE + len(layout))
+            columns_offset = _align(status_offset + status_size)
+            if status_offset == self.status_offset:
+                break
+            self.status_offset = status_offset
+            self.columns_offset = columns_offset
+            layout = json.dumps({
+                "window": window,
+                "columns": self.columns,
+                "status_offset": status_offset,
+                "status_size": status_size,
+                "columns_offset": columns_offset,
+            }).encode()
+        self.layout = layout
+        size = self.columns_offset + len(self.columns) * window * 8
+
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix=".snapshot")
+        try:
+            os.ftruncate(fd, size)
+            self.mmap = mmap.mmap(fd, size)
+            self._write_header()
+            self.mmap[HEADER_SIZE:HEADER_SIZE + len(layout)] = layout
+            os.fchmod(fd, 0o644)
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+        finally:
+            os.close(fd)
+
+    def _write_header(self):
+        struct.pack_into(HEADER_FORMAT, self.mmap, 0, FILE_MAGIC, FILE_VERSION, HEADER_SIZE,
+                         self.sequence, self.update_time, self.end_timestamp, self.end_counter,
+                         self.status_length, self.count, self.head, len(self.layout))
+
+    def _write_sequence(self):
+        struct.pack_into("<Q", self.mmap, SEQUENCE_OFFSET, self.sequence)
+
+    def _write_samples(self, bulk, start, count):
+        # start and count are within bulk and may not exceed window
+        first = self.head
+        split = min(count, self.window - first)
+        for i, column in enumerate(self.columns):
+            values = bulk.get(column)
+            if values is None:
+                data = array("d", [math.nan]) * count
+            else:
+                data = array("d", (_float_or_nan(x) for x in values[start:start + count]))
+            if not LITTLE_ENDIAN:
+                data.byteswap()
+            offset = self.columns_offset + i * self.window * 8
+            data = data.tobytes()
+            self.mmap[offset + first * 8:offset + (first+split) * 8] = data[:split * 8]
+            if split < count:
+                self.mmap[offset:offset + (count-split) * 8] = data[split * 8:]
+        self.head = (first+count) % self.window
+        self.count = min(self.count + count, self.window)
+
+    def update(self, status=None, bulk=None, count=0, timestamp=None, counter=None):
+        """Update the snapshot.
+
+        Args:
+            status (dict): Optionally, the new status data, which must be
+                serializable as JSON.
+            bulk (dict): Optionally, new bulk history data, as returned by
+                starlink_grpc.history_bulk_data.
+            count (int): The number of samples in bulk.
+            timestamp (int): Time of the sample just before the first one in
+                bulk, in seconds since the Unix epoch.
+            counter (int): Sample counter value of the sample just before the
+                first one in bulk.
+
+        Raises:
+            SnapshotError: The status data does not fit in the space allowed
+                for it. Any bulk history data is still written.
+        """
+        error = None
+        if status is not None:
+            status = json.dumps(status, separators=(",", ":")).encode()
+            if len(status) > self.status_size:
+                error = SnapshotError("Status data too large: {0} bytes".format(len(status)))
+                status = None
+
+        self.sequence += 1
+        self._write_sequence()
+        try:
+            self.update_time = time.time()
+            if status is not None:
+                self.mmap[self.status_offset:self.status_offset + len(status)] = status
+                self.status_length = len(status)
+            if bulk is not None and count:
+                # Samples in the window must be consecutive, so start over if
+                # some were missed or the counter started over.
+                if counter != self.end_counter:
+                    self.count = 0
+                    self.head = 0
+                skip = max(count - self.window, 0)
+                self._write_samples(bulk, skip, count - skip)
+                self.end_timestamp = timestamp + count
+                self.end_counter = counter + count
+        finally:
+            # The rest of the header goes first, so the sequence number does
+            # not go even until everything else is in place.
+            self._write_header()
+            self.sequence += 1
+            self._write_sequence()
+
+        if error is not None:
+            raise error
+
+    def close(self):
+        self.mmap.close()
+
+
+class SnapshotReader:
+    """Read snapshots from a file written by SnapshotWriter.
+
+    The file is mapped into memory on first use and kept open, but is mapped
+    again if it gets replaced.
+
+    Args:
+        filename (str): The snapshot file to read.
+    """
+    def __init__(self, filename=None):
+        self.filename = default_filename() if filename is None else filename
+        self.mmap = None
+        self.file_id = None
+        self.layout = None
+
+    def _open(self):
+        with open(self.filename, "rb") as snap_file:
+            stat = os.fstat(snap_file.fileno())
+            snap_mmap = mmap.mmap(snap_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(snap_mmap) < HEADER_SIZE:
+                raise SnapshotError("Snapshot file too short")
+            header = struct.unpack_from(HEADER_FORMAT, snap_mmap, 0)
+            if header[0] != FILE_MAGIC or header[1] != FILE_VERSION:
+                raise SnapshotError("Not a snapshot file, or unsupported version")
+            layout_offset = header[2]
+            layout = json.loads(bytes(snap_mmap[layout_offset:layout_offset + header[-1]]))
+        except BaseException:
+            snap_mmap.close()
+            raise
+        self.close()
+        self.mmap = snap_mmap
+        self.file_id = (stat.st_dev, stat.st_ino)
+        self.layout = layout
+
+    def _check_file(self):
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            if self.mmap is None:
+                raise
+            # in the middle of being replaced, maybe, so keep using the old one
+            return
+        if (stat.st_dev, stat.st_ino) != self.file_id:
+            self._open()
+
+    def read(self):
+        """Read a consistent snapshot.
+
+        Returns:
+            A dict with the status data, as described in the module docs, and
+            additionally "update_time" mapping to the time of the last update
+            and "history" mapping to a dict of the bulk history data, with
+            "end_timestamp", "end_counter", and "samples" mapping to the time
+            and counter value of the most recent sample and the number of
+            samples, respectively, and each of the bulk history field names
+            mapping to a list of that field's values, from oldest to newest.
+
+        Raises:
+            OSError: Failed opening the snapshot file.
+            SnapshotError: The file is not a snapshot file or no consistent
+                snapshot could be read.
+        """
+        self._check_file()
+        snap_mmap = self.mmap
+        window = self.layout["window"]
+        columns = self.layout["columns"]
+        status_offset = self.layout["status_offset"]
+        columns_offset = self.layout["columns_offset"]
+
+        for _ in range(READ_TRIES):
+            header = struct.unpack_from(HEADER_FORMAT, snap_mmap, 0)
+            sequence = header[3]
+            if sequence & 1:
+                time.sleep(READ_RETRY_DELAY)
+                continue
+            status = snap_mmap[status_offset:status_offset + header[7]]
+            count, head = header[8], header[9]
+            first = (head-count) % window
+            data = []
+            for i in range(len(columns)):
+                offset = columns_offset + i * window * 8
+                if first + count <= window:
+                    data.append(snap_mmap[offset + first * 8:offset + (first+count) * 8])
+                else:
+                    data.append(snap_mmap[offset + first * 8:offset + window * 8] +
+                                snap_mmap[offset:offset + head * 8])
+            if struct.unpack_from("<Q", snap_mmap, SEQUENCE_OFFSET)[0] == sequence:
+                break
+        else:
+            raise SnapshotError("Snapshot file is being updated too often to read")
+
+        snapshot = json.loads(status) if status else {}
+        snapshot["update_time"] = header[4]
+        history = {"end_timestamp": header[5], "end_counter": header[6], "samples": count}
+        for column, column_data in zip(columns, data):
+            values = array("d")
+            values.frombytes(column_data)
+            if not LITTLE_ENDIAN:
+                values.byteswap()
+            history[column] = [None if math.isnan(x) else x for x in values]
+        snapshot["history"] = history
+        return snapshot
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+
+def main():
+    # Print the current snapshot as JSON, for use from shell scripts
+    filename = sys.argv[1] if len(sys.argv) > 1 else None
+    reader = SnapshotReader(filename)
+    try:
+        json.dump(reader.read(), sys.stdout)
+        print()
+    except (OSError, SnapshotError) as e:
+        print("Failed reading snapshot: " + str(e), file=sys.stderr)
+        sys.exit(1)
+    finally:
+        reader.close()
+
+
+if __name__ == '__main__':
+    main()